@@ -0,0 +1,48 @@
+import subprocess
+import sys
+
+#
+# startup benchmark #
+#
+# times import of rfpipe and construction of State in fresh interpreters.
+# lightweight State (no validate/summary) computes no derived quantities
+# (dmarr, segmenttimes, uvrange) until they are used. from_snapshot also
+# skips them on use, as for workers and CandCollection.state.
+
+setup = """
+from astropy import time
+t0 = time.Time.now().mjd
+meta = rfpipe.metadata.mock_metadata(t0, t0+5/(24*3600), 27, 16, 32*16, 4,
+                                     5e3, datasource='sim', antconfig='D')
+"""
+
+cases = [('import rfpipe', 'import rfpipe', ''),
+         ('import search/candidates', 'import rfpipe.search, rfpipe.candidates',
+          'import rfpipe'),
+         ('State (lightweight)',
+          "rfpipe.state.State(inmeta=meta, validate=False, showsummary=False)",
+          'import rfpipe' + setup),
+         ('State (from snapshot)',
+          "rfpipe.state.State.from_snapshot(snap).dmarr",
+          'import rfpipe' + setup +
+          'snap = rfpipe.state.State(inmeta=meta, showsummary=False).snapshot()'),
+         ('State (validate)',
+          "rfpipe.state.State(inmeta=meta, showsummary=False)",
+          'import rfpipe' + setup),
+         ('State (full)', "rfpipe.state.State(inmeta=meta)",
+          'import rfpipe' + setup)]
+
+script = """
+from timeit import default_timer
+{1}
+t0 = default_timer()
+{0}
+print(default_timer() - t0)
+"""
+
+print('{0:>26} {1:>10}'.format('step', 'time (s)'))
+for name, stmt, pre in cases:
+    out = subprocess.check_output([sys.executable, '-c',
+                                   script.format(stmt, pre)],
+                                  stderr=subprocess.STDOUT)
+    print('{0:>26} {1:>10.3f}'.format(name, float(out.split()[-1])))
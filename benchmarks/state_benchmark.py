@@ -0,0 +1,31 @@
+import rfpipe
+import timeit
+from astropy import time
+
+#
+# state attribute access benchmark #
+#
+# times access of properties used in search loops and pixtolm with
+# memoized values and with cache cleared before each access.
+
+t0 = time.Time.now().mjd
+meta = rfpipe.metadata.mock_metadata(t0, t0+0.3/(24*3600), 27, 16, 32*16, 4,
+                                     5e3, datasource='sim', antconfig='D')
+st = rfpipe.state.State(inmeta=meta, inprefs={'npix_max': 512},
+                        showsummary=False)
+
+attrs = ['freq', 'chans', 'nchan', 'spw_chan_select', 'ants', 'nbl',
+         'blarr_names', 'blarr_arms', 'datashape', 'gainfile']
+number = 1000
+
+print('{0:>16} {1:>12} {2:>12}'.format('property', 'memo (us)', 'fresh (us)'))
+for attr in attrs:
+    memo = timeit.timeit(lambda: getattr(st, attr), number=number)
+    fresh = timeit.timeit(lambda: (st.__dict__.pop('_memokey', None),
+                                   getattr(st, attr)), number=number)
+    print('{0:>16} {1:>12.2f} {2:>12.2f}'.format(attr, 1e6*memo/number,
+                                                 1e6*fresh/number))
+
+pix = (st.npixx//3, st.npixy//3)
+memo = timeit.timeit(lambda: st.pixtolm(pix), number=number)
+print('{0:>16} {1:>12.2f}'.format('pixtolm', 1e6*memo/number))
@@ -6,23 +6,31 @@ from io import open
 import pickle
 import numpy as np
 import os.path
-from collections import Counter
+import time
+import hashlib
+from collections import OrderedDict
 from numba import jit
 from rfpipe import fileLock
 
 import logging
 logger = logging.getLogger(__name__)
 
+# calibration arrays by solutions and data selection. few kept, as each is
+# the size of one integration of data.
+_gaindelaycache = OrderedDict()
+_gaindelaycachesize = 4
+
 
 ### Functional form
 
 def apply_telcal(st, data, threshold=1/10., onlycomplete=True, sign=+1,
-                 savesols=False, returnsoltime=False):
+                 savesols=False, returnsoltime=False, inplace=False):
     """ Wrap all telcal functions to parse telcal file and apply it to data
     sign defines if calibration is applied (+1) or backed out (-1).
     assumes dual pol and that each spw has same nch and chansize.
     Threshold is minimum ratio of gain amp to median gain amp.
     If no solution found, it will blank the data to zeros.
+    inplace will multiply data by calibration without copy.
     """
 
     assert sign in [-1, +1], 'sign must be +1 or -1'
@@ -40,46 +48,78 @@ def apply_telcal(st, data, threshold=1/10., onlycomplete=True, sign=+1,
             reffreq, nchan, chansize = st.metadata.spw_sorted_properties
             skyfreqs = np.around([reffreq[i] + (chansize[i]*nchan[i]//2) for i in range(len(nchan))], -6)/1e6  # GN skyfreq is band center
             if len(sols):
-                pols = [0, 1]
                 solskyfreqs = np.unique(sols['skyfreq'])
                 logger.info("Applying solutions from frequencies {0} to data frequencies {1}"
                             .format(solskyfreqs, np.unique(skyfreqs)))
-                gaindelay = np.nan_to_num(calcgaindelay(sols, st.blarr,
-                                                        skyfreqs, pols,
-                                                        chansize[0]/1e6,
-                                                        nchan[0], sign=sign),
-                                          copy=False).take(st.chans, axis=1)
+                gaindelay = getgaindelay(st, sols, skyfreqs, sign=sign)
             else:
                 logger.info("No calibration solutions found for data freqs {0}"
                             .format(np.unique(skyfreqs)))
-                gaindelay = np.zeros_like(data)
-
-        # check for repeats or bad values
-        repeats = [(item, count) for item, count in Counter(gaindelay[:, ::nchan[0]].flatten()).items() if count > 1]
-        if len(repeats):
-            for item, count in repeats:
-                if item == 0j:
-                    logger.info("{0} of {1} telcal solutions zeroed or flagged"
-                                .format(count, gaindelay[:, ::nchan[0]].size))
-                    if gaindelay.any():
-                        blinds, chans, pols = np.where(gaindelay[:, ::nchan[0]] == 0)
-                        if len(blinds):
-                            counts = list(zip(*np.histogram(st.blarr[np.unique(blinds)].flatten(),
-                                                            bins=np.arange(1,
-                                                                           1+max(st.blarr[np.unique(blinds)].flatten())))))
-
-                            logger.info('Flagged solutions for: {0}'
-                                        .format(', '.join(['Ant {1}: {0}'.format(a, b)
-                                                           for (a, b) in counts])))
-                else:
-                    logger.warn("Repeated telcal solutions ({0}: {1}) found. Likely a parsing error!"
-                                .format(item, count))
+                gaindelay = np.zeros(data.shape[1:], dtype=np.complex64)
+
+        # check for repeats or bad values in one channel per spw
+        solarr = gaindelay[:, ::nchan[0]]
+        items, counts = np.unique(solarr, return_counts=True)
+        for item, count in zip(items[counts > 1], counts[counts > 1]):
+            if item == 0j:
+                logger.info("{0} of {1} telcal solutions zeroed or flagged"
+                            .format(count, solarr.size))
+                if gaindelay.any():
+                    blinds = np.unique(np.where(solarr == 0)[0])
+                    if len(blinds):
+                        antcounts = list(zip(*np.histogram(st.blarr[blinds].flatten(),
+                                                           bins=np.arange(1,
+                                                                          1+max(st.blarr[blinds].flatten())))))
+
+                        logger.info('Flagged solutions for: {0}'
+                                    .format(', '.join(['Ant {1}: {0}'.format(a, b)
+                                                       for (a, b) in antcounts])))
+            else:
+                logger.warn("Repeated telcal solutions ({0}: {1}) found. Likely a parsing error!"
+                            .format(item, count))
+
+        if inplace:
+            data = np.require(data, requirements='W')
+            data *= gaindelay[None]
+        else:
+            data = data*gaindelay
 
         if returnsoltime:
             soltime = np.unique(sols['mjd'])
-            return data*gaindelay, soltime
+            return data, soltime
         else:
-            return data*gaindelay
+            return data
+
+
+def getgaindelay(st, sols, skyfreqs, sign=1):
+    """ Gets calibration array for selected data of state st from sols.
+    Arrays are memoized by solutions, baselines, frequencies, channels and
+    sign, so segments (and mock transients) with the same solutions reuse it.
+    Returned array is read-only.
+    """
+
+    pols = [0, 1]
+    reffreq, nchan, chansize = st.metadata.spw_sorted_properties
+    key = (hashlib.md5(sols.tobytes()).hexdigest(), st.blarr.tobytes(),
+           tuple(st.chans), tuple(skyfreqs), chansize[0], nchan[0], sign)
+
+    if key in _gaindelaycache:
+        logger.debug('Using cached calibration array')
+        gaindelay = _gaindelaycache.pop(key)
+        _gaindelaycache[key] = gaindelay
+        return gaindelay
+
+    gaindelay = np.nan_to_num(calcgaindelay(sols, st.blarr, skyfreqs, pols,
+                                            chansize[0]/1e6, nchan[0],
+                                            sign=sign),
+                              copy=False).take(st.chans, axis=1)
+    gaindelay.flags.writeable = False
+
+    _gaindelaycache[key] = gaindelay
+    while len(_gaindelaycache) > _gaindelaycachesize:
+        _gaindelaycache.popitem(last=False)
+
+    return gaindelay
 
 
 def getsols(st, threshold=1/10., onlycomplete=True, mode='realtime',
@@ -108,66 +148,73 @@ def getsols(st, threshold=1/10., onlycomplete=True, mode='realtime',
     return sols
 
 
+# Define telcal file formatting
+MJD = 0; UTC = 1; LSTD = 2; LSTS = 3; IFID = 4; SKYFREQ = 5; ANT = 6; AMP = 7; PHASE = 8
+RESIDUAL = 9; DELAY = 10; FLAGGED = 11; ZEROED = 12; HA = 13; AZ = 14; EL = 15
+SOURCE = 16; FLAGREASON = 17
+
+# parsed telcal files by path. telcal files grow during observing, so
+# state of reading is kept to parse only appended lines.
+_gncache = {}
+gnsettle = 5.  # seconds unchanged before a last line without newline is read
+
+
 def parseGN(telcalfile):
     """Takes .GN telcal file and places values in numpy arrays.
     threshold and onlycomplete define flagging of low gains and incomplete
     solutions.
+    Parsed solutions are cached by path, size and modification time, so
+    repeated calls for an unchanged file return the same (read-only) array.
+    If the file has grown, only the appended lines are parsed. A last line
+    without newline may still be written. It is returned only once the file
+    is unchanged for gnsettle seconds and is parsed again until then.
     """
 
-    # Define telcal file formatting
     skip = 3   # skip first three header lines
-    MJD = 0; UTC = 1; LSTD = 2; LSTS = 3; IFID = 4; SKYFREQ = 5; ANT = 6; AMP = 7; PHASE = 8
-    RESIDUAL = 9; DELAY = 10; FLAGGED = 11; ZEROED = 12; HA = 13; AZ = 14; EL = 15
-    SOURCE = 16; FLAGREASON = 17
-
-    mjd = []
-    ifid = []
-    skyfreq = []
-    antnum = []
-    amp = []
-    phase = []
-    delay = []
-    flagged = []
-    source = []
-
-    i = 0
-    with open(telcalfile, 'r') as fp:
-        for line in fp:
-
-            fields = line.split()
-            if i < skip:
-                i += 1
-                continue
-
-            try:
-                mjd.append(float(fields[MJD]))
-                ifid.append(str(fields[IFID]))
-                skyfreq.append(float(fields[SKYFREQ]))
-                antnum.append(int(fields[ANT].lstrip('ea')))
-                amp.append(float(fields[AMP]))
-                phase.append(float(fields[PHASE]))
-                delay.append(float(fields[DELAY]))
-                flagged.append('true' == (fields[FLAGGED]))
-                source.append(str(fields[SOURCE]))
-            except ValueError:
-                logger.warning('Trouble parsing line of telcal file. Skipping.')
-                continue
-
-    # TODO: assumes dual pol. update to full pol
-    polarization = [('C' in i0 or 'D' in i0) for i0 in ifid]
-    fields = [u'mjd', u'ifid', u'skyfreq', u'antnum', u'polarization', u'source', u'amp', u'phase', u'delay', u'flagged']
-#    fields = [str('mjd'), str('ifid'), str('skyfreq'), str('antnum'),
-#              str('polarization'), str('source'), str('amp'), str('phase'),
-#              str('delay'), str('flagged')]
-    types = ['<f8', 'U4', '<f8', 'i8', 'i8', 'U20', '<f8', '<f8', '<f8', '?']
-    dtype = np.dtype({'names': fields, 'formats': types})
-    if (len(mjd) == len(phase)) and (len(phase) > 0):
-        sols = np.zeros(len(mjd), dtype=dtype)
 
-        for i in range(len(mjd)):
-            sols[i] = (mjd[i], ifid[i], skyfreq[i], antnum[i], polarization[i],
-                       source[i], amp[i], phase[i], delay[i], flagged[i])
+    path = os.path.abspath(telcalfile)
+    stat = os.stat(path)
+    key = (stat.st_ino, stat.st_size, stat.st_mtime)
+    cache = _gncache.get(path)
+    if cache is not None and cache['key'] == key:
+        logger.debug('Using cached solutions for telcalfile {0}'
+                     .format(telcalfile))
+        return cache['sols']
+
+    if ((cache is not None) and (cache['ino'] == stat.st_ino) and
+       (stat.st_size >= cache['offset'])):
+        offset = cache['offset']
+        nskip = cache['nskip']
+        complete = cache['complete']
+    else:
+        offset = 0
+        nskip = skip
+        complete = None
+
+    with open(path, 'rb') as fp:
+        fp.seek(offset)
+        text = fp.read()
+
+    # newline-terminated lines are kept. partial last line is read again.
+    end = text.rfind(b'\n') + 1
+    lines = text[:end].decode('utf-8').splitlines()
+    tail = text[end:].decode('utf-8')
+    nskip0 = max(0, nskip-len(lines))
+
+    sols = parseGNlines(lines[nskip:])
+    if complete is not None:
+        logger.info('Read {0} new solutions from telcalfile {1}'
+                    .format(len(sols), telcalfile))
+        sols = np.concatenate((complete, sols))
+    complete = sols
+
+    if tail.strip() and not nskip0:
+        if time.time() - stat.st_mtime >= gnsettle:
+            sols = np.concatenate((complete, parseGNlines([tail])))
+        else:
+            key = None  # not final. parse tail on next call.
 
+    if len(sols) and offset == 0:
         logger.info('Read telcalfile {0} with {1} sources, {2} times, {3} '
                     'IFIDs, and {4} antennas'
                     .format(telcalfile,
@@ -175,13 +222,103 @@ def parseGN(telcalfile):
                             len(np.unique(sols['mjd'])),
                             len(np.unique(sols['ifid'])),
                             len(np.unique(sols['antnum']))))
+
+    if len(sols):
+        sols.flags.writeable = False
     else:
         logger.warning('Bad telcalfile {0}. Not parsed properly'.format(telcalfile))
         sols = np.array([])
 
+    _gncache[path] = {'key': key, 'ino': stat.st_ino, 'offset': offset+end,
+                      'nskip': nskip0, 'complete': complete, 'sols': sols}
+
+    return sols
+
+
+def parseGNlines(lines):
+    """ Parses lines (without header) of .GN telcal file into structured
+    array of solutions. Columns are converted in bulk with np.loadtxt.
+    Lines that cannot be parsed are skipped.
+    """
+
+    fields = [u'mjd', u'ifid', u'skyfreq', u'antnum', u'polarization', u'source', u'amp', u'phase', u'delay', u'flagged']
+#    fields = [str('mjd'), str('ifid'), str('skyfreq'), str('antnum'),
+#              str('polarization'), str('source'), str('amp'), str('phase'),
+#              str('delay'), str('flagged')]
+    types = ['<f8', 'U4', '<f8', 'i8', 'i8', 'U20', '<f8', '<f8', '<f8', '?']
+    dtype = np.dtype({'names': fields, 'formats': types})
+
+    # columns as read from file
+    colnames = [str('mjd'), str('ifid'), str('skyfreq'), str('ant'),
+                str('amp'), str('phase'), str('delay'), str('flagged'),
+                str('source')]
+    coltypes = ['<f8', 'U8', '<f8', 'U8', '<f8', '<f8', '<f8', 'U8', 'U20']
+    usecols = [MJD, IFID, SKYFREQ, ANT, AMP, PHASE, DELAY, FLAGGED, SOURCE]
+    coldtype = np.dtype({'names': colnames, 'formats': coltypes})
+
+    if not any([line.strip() for line in lines]):
+        return np.zeros(0, dtype=dtype)
+
+    try:
+        cols = np.loadtxt(lines, dtype=coldtype, usecols=usecols,
+                          comments=None, ndmin=1)
+    except (ValueError, IndexError):
+        goodlines = [line for line in lines if _parseGNline(line)]
+        logger.warning('Trouble parsing {0} lines of telcal file. Skipping.'
+                       .format(len(lines)-len(goodlines)))
+        if not goodlines:
+            return np.zeros(0, dtype=dtype)
+        cols = np.loadtxt(goodlines, dtype=coldtype, usecols=usecols,
+                          comments=None, ndmin=1)
+
+    # parse string columns once per unique value
+    ants, antinds = np.unique(cols['ant'], return_inverse=True)
+    antnums = np.array([_parseGNant(ant) for ant in ants], dtype=int)[antinds]
+    if (antnums < 0).any():
+        logger.warning('Trouble parsing {0} lines of telcal file. Skipping.'
+                       .format((antnums < 0).sum()))
+        cols = cols[antnums >= 0]
+        antnums = antnums[antnums >= 0]
+
+    sols = np.zeros(len(cols), dtype=dtype)
+    for field in ['mjd', 'ifid', 'skyfreq', 'source', 'amp', 'phase', 'delay']:
+        sols[field] = cols[field]
+
+    sols['antnum'] = antnums
+    ifids, ifidinds = np.unique(cols['ifid'], return_inverse=True)
+    # TODO: assumes dual pol. update to full pol
+    sols['polarization'] = np.array([('C' in i0 or 'D' in i0) for i0 in ifids],
+                                    dtype=int)[ifidinds]
+    sols['flagged'] = cols['flagged'] == 'true'
+
     return sols
 
 
+def _parseGNant(ant):
+    """ Antenna number from name (e.g., 'ea01'). Returns -1 if not valid.
+    """
+
+    try:
+        return int(ant.lstrip('ea'))
+    except ValueError:
+        return -1
+
+
+def _parseGNline(line):
+    """ Tests whether line of telcal file can be parsed.
+    """
+
+    fields = line.split()
+    try:
+        fields[SOURCE]
+        for ind in [MJD, SKYFREQ, AMP, PHASE, DELAY]:
+            float(fields[ind])
+    except (ValueError, IndexError):
+        return False
+
+    return True
+
+
 def flagants(solsin, threshold, onlycomplete):
     """ Flags solutions with amplitude more than threshold larger than median.
     onlycomplete defines whether to flag times with incomplete solutions.
@@ -243,8 +380,7 @@ def select(sols, time=None, freqs=None, polarization=None, mode='realtime'):
         deltaf = freqs[1] - freqs[0]
         fmin = freqs.min() - deltaf
         fmax = freqs.max() + deltaf
-        freqselect = [(ff > fmin) and (ff < fmax)
-                      for ff in sols['skyfreq']]
+        freqselect = (sols['skyfreq'] > fmin) & (sols['skyfreq'] < fmax)
     else:
         freqselect = np.ones(len(sols), dtype=bool)
 
@@ -285,49 +421,59 @@ def select(sols, time=None, freqs=None, polarization=None, mode='realtime'):
     return sols[selection]
 
 
-@jit(cache=True)
 def calcgaindelay(sols, bls, freqarr, pols, chansize, nch, sign=1):
     """ Build gain calibraion array with shape to project into data
     freqarr is a list of reffreqs in MHz.
     chansize is channel size per spw in MHz.
+    Solutions are indexed into antenna gain/delay tables first and baseline
+    gains are the product of antenna gains.
     """
 
     assert sign in [-1, +1], 'sign must be +1 or -1'
+    bls = np.asarray(bls)
     nspw = len(freqarr)
-    gaindelay = np.zeros((len(bls), nspw*nch, len(pols)), dtype=np.complex64)
-    g1g2 = 0.
-
-    for bi in range(len(bls)):
-        ant1, ant2 = bls[bi]
-        for fi in range(len(freqarr)):
-            relfreq = chansize*(np.arange(nch) - nch//2)*1e6
-
-            for pi in range(len(pols)):
-                g1 = 0.
-                g2 = 0.
-                d1 = 0.
-                d2 = 0.
-                for sol in sols:
-                    if ((sol['polarization'] == pols[pi]) and (np.abs(sol['skyfreq']-freqarr[fi]) < chansize) and (not sol['flagged'])):
-                        if sol['antnum'] == ant1:
-                            g1 = sol['amp']*np.exp(1j*np.radians(sol['phase']))
-                            d1 = sol['delay']
-                        if sol['antnum'] == ant2:
-                            g2 = sol['amp']*np.exp(-1j*np.radians(sol['phase']))
-                            d2 = sol['delay']
-
-                if (g1 != 0.) and (g2 != 0.):
-                    if sign == 1:
-                        g1g2 = 1./(g1*g2)
-                    elif sign == -1:
-                        g1g2 = (g1*g2)
-                else:
-                    g1g2 = 0.
-
-                d1d2 = sign*2*np.pi*((d1-d2) * 1e-9) * relfreq
-                gaindelay[bi, fi*nch:(fi+1)*nch, pi] = g1g2*np.exp(-1j*d1d2)
 
-    return gaindelay
+    ants = np.unique(np.concatenate((bls.flatten(), sols['antnum'])))
+    gain, delay = calcgaintable(sols, ants, freqarr, pols, chansize)
+    ant1 = np.searchsorted(ants, bls[:, 0])
+    ant2 = np.searchsorted(ants, bls[:, 1])
+
+    # (nbl, nspw, npol)
+    g1g2 = gain[ant1]*gain[ant2].conj()
+    valid = g1g2 != 0.
+    if sign == 1:
+        g1g2[valid] = 1./g1g2[valid]
+    d1d2 = sign*2*np.pi*((delay[ant1]-delay[ant2]) * 1e-9)
+
+    relfreq = chansize*(np.arange(nch) - nch//2)*1e6
+    gaindelay = (g1g2[:, :, None, :] *
+                 np.exp(-1j*d1d2[:, :, None, :]*relfreq[None, None, :, None]))
+
+    return gaindelay.reshape(len(bls), nspw*nch, len(pols)).astype(np.complex64)
+
+
+def calcgaintable(sols, ants, freqarr, pols, chansize):
+    """ Index unflagged solutions into gain and delay tables with shape
+    (len(ants), len(freqarr), len(pols)).
+    Gain is zero where no solution is found. Later solutions take precedence.
+    ants must be sorted and include all sols antnum.
+    """
+
+    gain = np.zeros((len(ants), len(freqarr), len(pols)), dtype=np.complex128)
+    delay = np.zeros((len(ants), len(freqarr), len(pols)), dtype=np.float64)
+
+    polind = np.array([pols.index(pol) if pol in pols else -1
+                       for pol in sols['polarization']], dtype=int)
+    match = ((np.abs(sols['skyfreq'][:, None] - np.asarray(freqarr)[None, :]) < chansize) &
+             (~sols['flagged'][:, None]) & (polind[:, None] >= 0))
+    solind, freqind = np.where(match)
+
+    antind = np.searchsorted(ants, sols['antnum'][solind])
+    gain[antind, freqind, polind[solind]] = (sols['amp'][solind] *
+                                             np.exp(1j*np.radians(sols['phase'][solind])))
+    delay[antind, freqind, polind[solind]] = sols['delay'][solind]
+
+    return gain, delay
 
 
 ### Class form
@@ -10,22 +10,28 @@ import numpy as np
 from math import cos, radians
 from numpy.lib.recfunctions import append_fields
 from collections import OrderedDict
-import matplotlib as mpl
-from astropy import time
-mpl.use('Agg')
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_agg import FigureCanvasAgg
-from rfpipe import version, fileLock
-from bokeh.plotting import ColumnDataSource, Figure, save, output_file
-import scipy.stats.mstats as mstats
-from bokeh.models import HoverTool
-from bokeh.models import Row
-from collections import OrderedDict
-import hdbscan
+from rfpipe import version, fileLock, lazy
 
 import logging
 logger = logging.getLogger(__name__)
 
+
+def _pyplot():
+    """ pyplot with Agg backend set for candidate plots """
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot
+    return matplotlib.pyplot
+
+
+# plotting and clustering libraries imported on first use
+mpl = lazy.lazy_import('matplotlib')
+plt = lazy.LazyObject(_pyplot)
+time = lazy.lazy_import('astropy.time')
+mstats = lazy.lazy_import('scipy.stats.mstats')
+hdbscan = lazy.lazy_import('hdbscan')
+
 class CandData(object):
     """ Object that bundles data from search stage to candidate visualization.
     Provides some properties for the state of the phased data and candidate.
@@ -62,6 +68,20 @@ class CandData(object):
                                                           "should set each of "
                                                           "the st.search_dimensions")
 
+    def __getstate__(self):
+        """ Pickle state as compact snapshot """
+
+        d = self.__dict__.copy()
+        d['state'] = self.state.snapshot()
+        return d
+
+    def __setstate__(self, d):
+        from rfpipe import state
+
+        if isinstance(d['state'], state.Snapshot):
+            d['state'] = state.State.from_snapshot(d['state'])
+        self.__dict__.update(d)
+
     def __repr__(self):
         return 'CandData for scanId {0} at loc {1}'.format(self.state.metadata.scanId, self.loc)
 
@@ -178,13 +198,23 @@ class CandCollection(object):
     prefs to be attached and pickled.
     """
 
-    def __init__(self, array=np.array([]), prefs=None, metadata=None):
+    def __init__(self, array=np.array([]), prefs=None, metadata=None,
+                 snapshot=None):
         self.array = array
         self.prefs = prefs
         self.metadata = metadata
+        # prefs/metadata are kept above, so snapshot holds only derived values
+        self.snapshot = snapshot.derived() if snapshot is not None else None
         self.rfpipe_version = version.__version__
         self._state = None
-        # TODO: pass in segmenttimes here to avoid recalculating during search?
+
+    def __getstate__(self):
+        """ State is not pickled. It is rebuilt from snapshot, if available.
+        """
+
+        d = self.__dict__.copy()
+        d['_state'] = None
+        return d
 
     def __repr__(self):
         if self.metadata is not None:
@@ -229,8 +259,10 @@ class CandCollection(object):
         elif not len(later) and len(cc):
             later.array = cc.array
 
-        # combine prefs simulated_transient
-        later.prefs.simulated_transient = later.prefs.simulated_transient or cc.prefs.simulated_transient
+        # combine prefs simulated_transient (set only on change to keep caches)
+        simulated_transient = later.prefs.simulated_transient or cc.prefs.simulated_transient
+        if simulated_transient is not later.prefs.simulated_transient:
+            later.prefs.simulated_transient = simulated_transient
 
         return later
 
@@ -245,7 +277,8 @@ class CandCollection(object):
 
     def __getitem__(self, key):
         return CandCollection(array=self.array.take([key]), prefs=self.prefs,
-                              metadata=self.metadata)
+                              metadata=self.metadata,
+                              snapshot=getattr(self, 'snapshot', None))
 
     @property
     def scan(self):
@@ -354,14 +387,22 @@ class CandCollection(object):
 
     @property
     def state(self):
-        """ Sets state by regenerating from the metadata and prefs.
+        """ Sets state from snapshot or by regenerating from the metadata
+        and prefs.
         """
 
         from rfpipe import state
 
         if self._state is None:
-            self._state = state.State(inmeta=self.metadata, inprefs=self.prefs,
-                                      showsummary=False, validate=False)
+            snapshot = getattr(self, 'snapshot', None)  # old pickles lack it
+            if snapshot is not None:
+                self._state = state.State.from_snapshot(snapshot,
+                                                        prefs=self.prefs,
+                                                        metadata=self.metadata)
+            else:
+                self._state = state.State(inmeta=self.metadata,
+                                          inprefs=self.prefs,
+                                          showsummary=False, validate=False)
 
         return self._state
 
@@ -378,9 +419,10 @@ class CandCollection(object):
             map_mocks = {}
             for mock in self.prefs.simulated_transient:
                 (segment, integration, dm, dt, amp, l0, m0) = mock
-                dmind0 = np.abs((np.array(self._state.dmarr)-dm)).argmin()
-                dtind0 = np.abs((np.array(self._state.dtarr)-dt)).argmin()
-                mockloc = (segment, integration, dmind0, dtind0, 0)
+                dmind0 = np.abs((np.array(self.state.dmarr)-dm)).argmin()
+                dtind0 = np.abs((np.array(self.state.dtarr)-dt/self.state.inttime)).argmin()
+                mockloc = (segment, integration//self.state.dtarr[dtind0],
+                           dmind0, dtind0, 0)
 
                 if mockloc in self.locs:
                     label = clusters[self.locs.index(mockloc)]
@@ -567,10 +609,12 @@ def make_candcollection(st, **kwargs):
 
             array[i] = tuple(ff)
         candcollection = CandCollection(array=array, prefs=st.prefs,
-                                        metadata=st.metadata)
+                                        metadata=st.metadata,
+                                        snapshot=st.snapshot())
     else:
         candcollection = CandCollection(prefs=st.prefs,
-                                        metadata=st.metadata)
+                                        metadata=st.metadata,
+                                        snapshot=st.snapshot())
 
     return candcollection
 
@@ -795,6 +839,25 @@ def iter_noise(noisefile):
                     break
 
 
+def iter_flags(flagfile):
+    """ Iterate through flagfile (as in st.flagfile) and any segment files
+    spilled next to it and return tuple of (segment, summary) for each
+    segment. Summary is structured array with one row per flagging stage
+    (see flagging.flag_data and source.save_flags).
+    """
+
+    import glob
+
+    flagfiles = [flagfile] if os.path.exists(flagfile) else []
+    flagfiles += sorted(glob.glob(os.path.splitext(flagfile)[0] + '_seg*.npy'))
+    for fn in flagfiles:
+        with open(fn, 'rb') as fp:
+            size = os.fstat(fp.fileno()).st_size
+            while fp.tell() < size:  # step through all saved segments
+                summary = np.load(fp)
+                yield (int(summary['segment'][0]), summary)
+
+
 ### bokeh summary plot
 def visualize_clustering(cc, clusterer):
     
@@ -876,6 +939,9 @@ def makesummaryplot(candsfile):
     TODO: modify to take candcollection
     """
 
+    from bokeh.plotting import save, output_file
+    from bokeh.models import Row
+
     time = []
     segment = []
     integration = []
@@ -943,6 +1009,9 @@ def plotdmt(data, circleinds=[], crossinds=[], edgeinds=[],
             plot_height=400, yrange=None):
     """ Make a light-weight dm-time figure """
 
+    from bokeh.plotting import ColumnDataSource, Figure
+    from bokeh.models import HoverTool
+
     fields = ['dm', 'time', 'sizes', 'colors', 'snrs', 'keys']
 
     if not len(circleinds):
@@ -1002,6 +1071,9 @@ def plotloc(data, circleinds=[], crossinds=[], edgeinds=[],
     extent is half size of (square) lm plot.
     """
 
+    from bokeh.plotting import ColumnDataSource, Figure
+    from bokeh.models import HoverTool
+
     fields = ['l1', 'm1', 'sizes', 'colors', 'snrs', 'keys']
 
     if not len(circleinds):
@@ -1107,6 +1179,8 @@ def candplot(canddatalist, snrs=None, cluster=None, outname=''):
     Written by Bridget Andersen and modified by Casey for rfpipe.
     """
 
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
     if not isinstance(canddatalist, list):
         logger.debug('Wrapping solo CandData object')
         canddatalist = [canddatalist]
@@ -2,7 +2,10 @@ from __future__ import print_function, division, absolute_import, unicode_litera
 from builtins import bytes, dict, object, range, map, input, str
 from future.utils import itervalues, viewitems, iteritems, listvalues, listitems
 
+import heapq
+import time
 import numpy as np
+from concurrent import futures
 from numba import jit
 from rfpipe import util
 
@@ -10,30 +13,115 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-def flag_data(st, data):
+def flag_data(st, data, returnsummary=False):
     """ Identifies bad data and flags it to 0.
     Converts to masked array for flagging, but returns zeroed numpy array.
+    If prefs.flagparallel is set, statistics are calculated independently
+    per spw and pol (as in rtpipe) on a pool of nthread threads.
+    If returnsummary, also returns structured array with one row per flagging
+    stage (first row is data zeroed before flagging). Counts are of newly
+    flagged visibilities per spw, pol and baseline.
     """
 
     datam = np.ma.masked_values(data, 0j, copy=False, shrink=False)
 
     spwchans = st.spw_chan_select
-    for flagparams in st.prefs.flaglist:
-        if len(flagparams) == 3:
-            mode, arg0, arg1 = flagparams
-        else:
-            mode, arg0 = flagparams
-
-        if mode == 'blstd':
-            flag_blstd(datam, arg0, arg1)
-        elif mode == 'badchtslide':
-            flag_badchtslide(datam, spwchans, arg0, arg1)
-        elif mode == 'badspw':
-            flag_badspw(datam, spwchans, arg0)
-        else:
-            logger.warning("Flaging mode {0} not available.".format(mode))
+    if st.prefs.flagparallel and st.prefs.nthread > 1:
+        ex = futures.ThreadPoolExecutor(max_workers=st.prefs.nthread)
+    else:
+        ex = None
+
+    if returnsummary:
+        summary = np.zeros(len(st.prefs.flaglist)+1,
+                           dtype=flagsummary_dtype(len(spwchans),
+                                                   datam.shape[3],
+                                                   datam.shape[1]))
+        counts = _flagcounts(datam.mask, spwchans)
+        _fillsummary(summary[0], 'initial', 0., counts, (0, 0, 0), datam.size)
+
+    try:
+        for i, flagparams in enumerate(st.prefs.flaglist):
+            t0 = time.time()
+            if len(flagparams) == 3:
+                mode, arg0, arg1 = flagparams
+            else:
+                mode, arg0 = flagparams
+
+            if mode == 'blstd':
+                if ex is not None:
+                    flag_blstd_parallel(datam, spwchans, arg0, arg1, ex)
+                else:
+                    flag_blstd(datam, arg0, arg1)
+            elif mode == 'badchtslide':
+                if ex is not None:
+                    flag_badchtslide_parallel(datam, spwchans, arg0, arg1, ex)
+                else:
+                    flag_badchtslide(datam, spwchans, arg0, arg1)
+            elif mode == 'badspw':
+                if ex is not None:
+                    flag_badspw_parallel(datam, spwchans, arg0, ex)
+                else:
+                    flag_badspw(datam, spwchans, arg0)
+            else:
+                logger.warning("Flaging mode {0} not available.".format(mode))
+
+            if returnsummary:
+                countsnew = _flagcounts(datam.mask, spwchans)
+                _fillsummary(summary[i+1], mode, time.time()-t0, countsnew,
+                             counts, datam.size)
+                counts = countsnew
+    finally:
+        if ex is not None:
+            ex.shutdown()
+
+    if returnsummary:
+        logger.info("Flagging summary (stage, seconds, fraction): {0}"
+                    .format(', '.join(['{0} {1:.2f} {2:.3f}'
+                                       .format(row['mode'], row['seconds'],
+                                               row['fraction'])
+                                       for row in summary])))
+        return datam.filled(0), summary
+    else:
+        return datam.filled(0)
 
-    return datam.filled(0)
+
+def flagsummary_dtype(nspw, npol, nbl):
+    """ Defines structured array for flagging summary.
+    Each row is a flagging stage with counts of newly flagged visibilities
+    and cumulative fraction of data flagged.
+    """
+
+    return np.dtype([(str('mode'), str('U16')), (str('seconds'), np.float32),
+                     (str('nflagged'), np.int64),
+                     (str('fraction'), np.float32),
+                     (str('spw'), np.int64, (nspw,)),
+                     (str('pol'), np.int64, (npol,)),
+                     (str('bl'), np.int64, (nbl,))])
+
+
+def _flagcounts(mask, spwchans):
+    """ Counts flagged visibilities per spw, pol and baseline in one pass.
+    """
+
+    blchpol = mask.sum(axis=0)
+    chpol = blchpol.sum(axis=0)
+
+    return (np.array([chpol[chans].sum() for chans in spwchans]),
+            chpol.sum(axis=0), blchpol.sum(axis=(1, 2)))
+
+
+def _fillsummary(row, mode, seconds, counts, countsold, size):
+    """ Sets row of summary given cumulative flag counts before and after.
+    """
+
+    perspw, perpol, perbl = counts
+    row['mode'] = mode
+    row['seconds'] = seconds
+    row['nflagged'] = perpol.sum() - np.sum(countsold[1])
+    row['fraction'] = perpol.sum()/size
+    row['spw'] = perspw - countsold[0]
+    row['pol'] = perpol - countsold[1]
+    row['bl'] = perbl - countsold[2]
 
 
 def flag_blstd(data, sigma, convergence):
@@ -46,24 +134,52 @@ def flag_blstd(data, sigma, convergence):
 
     blstd = np.ma.std(data, axis=1)
 
-    # iterate to good median and std values
-    blstdmednew = np.ma.median(blstd)
-    blstdstdnew = np.ma.std(blstd)
+    # flag blstd too high
+    badt, badch, badpol = np.where(_blstd_select(blstd, sigma, convergence))
+    logger.info("flagged by blstd: {0} of {1} total channel/time/pol cells."
+                .format(len(badt), sh[0]*sh[2]*sh[3]))
+
+    data.mask[badt, :, badch, badpol] = True
+
+
+def _blstd_select(blstd, sigma, convergence):
+    """ Iterate to good median and std of blstd and return boolean array
+    of cells with blstd too high (including those excluded while iterating).
+    Valid values are sorted once, so each iteration only moves a cut in the
+    sorted values and gets median and std from cumulative sums.
+    """
+
+    vals = np.sort(np.ma.compressed(blstd).astype(np.float64))
+    csum = np.cumsum(vals)
+    csum2 = np.cumsum(vals**2)
+    nkeep = len(vals)
+
+    blstdmednew, blstdstdnew = _sortedstats(vals, csum, csum2, nkeep)
     blstdstd = blstdstdnew*2  # TODO: is this initialization used?
     while (blstdstd-blstdstdnew)/blstdstd > convergence:
         blstdstd = blstdstdnew
         blstdmed = blstdmednew
-        blstd = np.ma.masked_where(blstd > blstdmed + sigma*blstdstd, blstd, copy=False)
-        blstdmednew = np.ma.median(blstd)
-        blstdstdnew = np.ma.std(blstd)
+        nkeep = min(nkeep, np.searchsorted(vals, blstdmed + sigma*blstdstd,
+                                           side='right'))
+        blstdmednew, blstdstdnew = _sortedstats(vals, csum, csum2, nkeep)
 
-    # flag blstd too high
-    badt, badch, badpol = np.where(blstd > blstdmednew + sigma*blstdstdnew)
-    logger.info("flagged by blstd: {0} of {1} total channel/time/pol cells."
-                .format(len(badt), sh[0]*sh[2]*sh[3]))
+    return ((np.ma.getdata(blstd) > blstdmednew + sigma*blstdstdnew) &
+            ~np.ma.getmaskarray(blstd))
+
+
+def _sortedstats(vals, csum, csum2, nkeep):
+    """ Median and std of first nkeep of sorted vals (with cumulative sums
+    csum and csum2 of vals and vals**2).
+    """
+
+    if nkeep == 0:
+        return np.nan, np.nan
+
+    med = (vals[(nkeep-1)//2] + vals[nkeep//2])/2.
+    mean = csum[nkeep-1]/nkeep
+    std = np.sqrt(max(csum2[nkeep-1]/nkeep - mean**2, 0.))
 
-    for i in range(len(badt)):
-        data.mask[badt[i], :, badch[i], badpol[i]] = True
+    return med, std
 
 
 def flag_badchtslide(data, spwchans, sigma, win):
@@ -73,6 +189,21 @@ def flag_badchtslide(data, spwchans, sigma, win):
     sh = data.shape
 
     meanamp = np.abs(data).mean(axis=1)
+    badch, badt = _badchtslide_select(meanamp, spwchans, sigma, win)
+
+    badtcnt = len(np.ma.unique(badt))
+    badchcnt = len(np.ma.unique(badch))
+    logger.info("flagged by badchtslide: {0}/{1} pol-times and {2}/{3} pol-chans."
+                .format(badtcnt, sh[0]*sh[3], badchcnt, sh[2]*sh[3]))
+
+    data.mask[:, :, badch[0], badch[1]] = True
+    data.mask[badt[0], :, :, badt[1]] = True
+
+
+def _badchtslide_select(meanamp, spwchans, sigma, win):
+    """ Given mean amplitude over baselines (int, chan, pol), returns
+    indices of bad (chan, pol) and (int, pol).
+    """
 
     # calc badch as deviation from median of window
     spec = meanamp.mean(axis=0)
@@ -85,16 +216,7 @@ def flag_badchtslide(data, spwchans, sigma, win):
     lcmed = slidedev(lc, win)
     badt = np.where(lcmed > sigma*np.ma.std(lcmed, axis=0))
 
-    badtcnt = len(np.ma.unique(badt))
-    badchcnt = len(np.ma.unique(badch))
-    logger.info("flagged by badchtslide: {0}/{1} pol-times and {2}/{3} pol-chans."
-                .format(badtcnt, sh[0]*sh[3], badchcnt, sh[2]*sh[3]))
-
-    for i in range(len(badch[0])):
-        data.mask[:, :, badch[0][i], badch[1][i]] = True
-
-    for i in range(len(badt[0])):
-        data.mask[badt[0][i], :, :, badt[1][i]] = True
+    return badch, badt
 
 
 def flag_badspw(data, spwchans, sigma):
@@ -107,24 +229,7 @@ def flag_badspw(data, spwchans, sigma):
     if nspw >= 4:
         # calc badspw
         spec = np.abs(data).mean(axis=3).mean(axis=1).mean(axis=0)
-        deviations = []
-        for chans in spwchans:
-            if spec[chans].count() > 3:
-                deviations.append(np.ma.std(spec[chans]))
-            else:
-                deviations.append(0)
-        deviations = np.ma.masked_equal(np.nan_to_num(deviations), 0)
-        logger.info("badspw flagging finds deviations per spw: {0}"
-                    .format(deviations))
-
-        badspw = []
-        badspwnew = np.where(deviations > sigma*np.ma.median(deviations))[0]
-        while len(badspwnew) > len(badspw):
-            badspw = badspwnew
-            goodspw = [spw for spw in range(nspw) if spw not in badspw]
-            badspwnew = np.where(deviations > sigma*np.ma.median(deviations.take(goodspw)))[0]
-
-        badspw = np.concatenate((badspw, np.where(deviations.mask)[0]))
+        badspw = _badspw_select(spec, spwchans, sigma)
 
         logger.info("flagged {0}/{1} spw ({2})"
                     .format(len(badspw), nspw, badspw))
@@ -136,29 +241,335 @@ def flag_badspw(data, spwchans, sigma):
         logger.warning("Fewer than 4 spw. Not performing badspw detetion.")
 
 
+def _badspw_select(spec, spwchans, sigma):
+    """ Given spectrum, returns indices of spw with large deviations.
+    """
+
+    nspw = len(spwchans)
+    deviations = []
+    for chans in spwchans:
+        if spec[chans].count() > 3:
+            deviations.append(np.ma.std(spec[chans]))
+        else:
+            deviations.append(0)
+    deviations = np.ma.masked_equal(np.nan_to_num(deviations), 0)
+    logger.info("badspw flagging finds deviations per spw: {0}"
+                .format(deviations))
+
+    badspw = []
+    badspwnew = np.where(deviations > sigma*np.ma.median(deviations))[0]
+    while len(badspwnew) > len(badspw):
+        badspw = badspwnew
+        goodspw = [spw for spw in range(nspw) if spw not in badspw]
+        badspwnew = np.where(deviations > sigma*np.ma.median(deviations.take(goodspw)))[0]
+
+    return np.concatenate((badspw, np.where(np.ma.getmaskarray(deviations))[0])).astype(int)
+
+
+def flag_blstd_parallel(data, spwchans, sigma, convergence, ex):
+    """ Parallel version of flag_blstd.
+    Statistics are calculated per spw/pol, each on a thread of executor ex.
+    Flags of all shards are merged into data mask.
+    """
+
+    sh = data.shape
+    jobs = [ex.submit(_blstd_shard, data, chans, pol, sigma, convergence)
+            for chans in spwchans for pol in range(sh[3])]
+
+    nflag = 0
+    for job in jobs:
+        badt, badch, pol = job.result()
+        data.mask[badt, :, badch, pol] = True
+        nflag += len(badt)
+
+    logger.info("flagged by blstd: {0} of {1} total channel/time/pol cells."
+                .format(nflag, sh[0]*sh[2]*sh[3]))
+
+
+def _blstd_shard(data, chans, pol, sigma, convergence):
+    """ Returns (int, chan, pol) to flag for single spw/pol of data.
+    """
+
+    chans = np.array(chans, dtype=np.int64)
+    blstd = _shard_stat(data, chans, pol, 'std')
+    if not blstd.count():
+        return np.array([], dtype=int), np.array([], dtype=int), pol
+
+    badt, badch = np.where(_blstd_select(blstd, sigma, convergence))
+
+    return badt, chans[badch], pol
+
+
+def flag_badchtslide_parallel(data, spwchans, sigma, win, ex):
+    """ Parallel version of flag_badchtslide.
+    Statistics are calculated per spw/pol, each on a thread of executor ex.
+    Bad times are flagged only in the spw/pol where they are found.
+    """
+
+    sh = data.shape
+    jobs = [ex.submit(_badchtslide_shard, data, chans, pol, sigma, win)
+            for chans in spwchans for pol in range(sh[3])]
+
+    badtcnt = 0
+    badchcnt = 0
+    for job in jobs:
+        badch, badt, chans, pol = job.result()
+        data.mask[:, :, badch, pol] = True
+        data.mask[badt[:, None], :, chans[None, :], pol] = True
+        badtcnt += len(badt)
+        badchcnt += len(badch)
+
+    logger.info("flagged by badchtslide: {0}/{1} spw-pol-times and {2}/{3} pol-chans."
+                .format(badtcnt, sh[0]*sh[3]*len(spwchans), badchcnt,
+                        sh[2]*sh[3]))
+
+
+def _badchtslide_shard(data, chans, pol, sigma, win):
+    """ Returns chans and ints to flag for single spw/pol of data.
+    """
+
+    chans = np.array(chans, dtype=np.int64)
+    meanamp = _shard_stat(data, chans, pol, 'meanabs')
+    if not meanamp.count():
+        return np.array([], dtype=int), np.array([], dtype=int), chans, pol
+
+    badch, badt = _badchtslide_select(meanamp[:, :, None],
+                                      [list(range(len(chans)))], sigma, win)
+
+    return chans[badch[0]], badt[0], chans, pol
+
+
+def flag_badspw_parallel(data, spwchans, sigma, ex):
+    """ Parallel version of flag_badspw.
+    Spw are compared to each other, so statistics are calculated per pol,
+    each on a thread of executor ex.
+    """
+
+    sh = data.shape
+    nspw = len(spwchans)
+
+    if nspw >= 4:
+        jobs = [ex.submit(_badspw_shard, data, spwchans, pol, sigma)
+                for pol in range(sh[3])]
+
+        for job in jobs:
+            badspw, pol = job.result()
+            logger.info("flagged {0}/{1} spw ({2}) in pol {3}"
+                        .format(len(badspw), nspw, badspw, pol))
+
+            for i in badspw:
+                data.mask[:, :, spwchans[i], pol] = True
+
+    else:
+        logger.warning("Fewer than 4 spw. Not performing badspw detetion.")
+
+
+def _badspw_shard(data, spwchans, pol, sigma):
+    """ Returns spw to flag for single pol of data.
+    """
+
+    chans = np.arange(data.shape[2], dtype=np.int64)
+    spec = _shard_stat(data, chans, pol, 'meanabs').mean(axis=0)
+
+    return _badspw_select(spec, spwchans, sigma), pol
+
+
+def _shard_stat(data, chans, pol, stat):
+    """ Calculates statistic over baselines for chans and pol of 4d masked
+    data. Returns masked array of shape (nint, len(chans)).
+    stat can be 'meanabs' or 'std'. Kernels release the gil.
+    """
+
+    result = np.zeros((data.shape[0], len(chans)), dtype=np.float64)
+    count = np.zeros((data.shape[0], len(chans)), dtype=np.int64)
+    if stat == 'meanabs':
+        _meanabs_jit(data.data, np.ma.getmaskarray(data), chans, pol, result,
+                     count)
+    elif stat == 'std':
+        _blstd_jit(data.data, np.ma.getmaskarray(data), chans, pol, result,
+                   count)
+
+    return np.ma.masked_array(result, mask=count == 0)
+
+
+@jit(nogil=True, nopython=True, cache=True)
+def _meanabs_jit(data, mask, chans, pol, result, count):
+    nint, nbl, nchan, npol = data.shape
+
+    for i in range(nint):
+        for j in range(nbl):
+            for k in range(len(chans)):
+                if not mask[i, j, chans[k], pol]:
+                    result[i, k] += abs(data[i, j, chans[k], pol])
+                    count[i, k] += 1
+
+        for k in range(len(chans)):
+            if count[i, k] > 0:
+                result[i, k] /= count[i, k]
+
+
+@jit(nogil=True, nopython=True, cache=True)
+def _blstd_jit(data, mask, chans, pol, result, count):
+    nint, nbl, nchan, npol = data.shape
+    mean = np.zeros(len(chans), dtype=np.complex128)
+
+    for i in range(nint):
+        mean[:] = 0j
+        for j in range(nbl):
+            for k in range(len(chans)):
+                if not mask[i, j, chans[k], pol]:
+                    mean[k] += data[i, j, chans[k], pol]
+                    count[i, k] += 1
+
+        for k in range(len(chans)):
+            if count[i, k] > 0:
+                mean[k] /= count[i, k]
+
+        for j in range(nbl):
+            for k in range(len(chans)):
+                if not mask[i, j, chans[k], pol]:
+                    diff = data[i, j, chans[k], pol] - mean[k]
+                    result[i, k] += diff.real*diff.real + diff.imag*diff.imag
+
+        for k in range(len(chans)):
+            if count[i, k] > 0:
+                result[i, k] = np.sqrt(result[i, k]/count[i, k])
+
+
 def slidedev(arr, win):
     """ Given a (len x 2) array, calculate the deviation from the median per pol.
-    Calculates median over a window, win.
+    Calculates median over a window, win, that leaves out the center sample.
+    Also accepts 1d arrays (e.g., a spectrum). Masked (or nan) values are
+    ignored in the median.
     """
 
-    med = np.zeros_like(arr)
-    for i in range(len(arr)):
-        inds = list(range(max(0, i-win//2), i)) + list(range(i+1, min(i+win//2, len(arr))))
-        med[i] = np.ma.median(arr.take(inds, axis=0), axis=0)
+    arr = np.ma.asarray(arr)
+    # adding 0. turns -0. into 0., so heap deletion by value finds it
+    values = np.require(arr.filled(np.nan), dtype=np.float64) + 0.
+    mask = np.ma.getmaskarray(arr) | np.isnan(values)
+    if values.ndim == 1:
+        med, medmask = _slidemed_jit(values[:, None], mask[:, None], win//2)
+        med = med[:, 0]
+        medmask = medmask[:, 0]
+    else:
+        med, medmask = _slidemed_jit(values.reshape(len(values), -1),
+                                     mask.reshape(len(mask), -1), win//2)
+        med = med.reshape(values.shape)
+        medmask = medmask.reshape(values.shape)
 
-    return arr-med
+    return arr-np.ma.masked_array(med, mask=medmask)
+
+
+@jit(nogil=True, nopython=True, cache=True)
+def _slidemed_jit(values, mask, halfwin):
+    """ Streaming median over window [i-halfwin, i+halfwin) excluding i.
+    Works on columns of 2d values with two heaps (lazy deletion), so each
+    integration costs O(log win) instead of a full median.
+    Returns median and mask (True where window has no valid values).
+    """
+
+    n, m = values.shape
+    med = np.zeros((n, m), dtype=np.float64)
+    medmask = np.ones((n, m), dtype=np.bool_)
+
+    for col in range(m):
+        lo = [0.]  # max heap, stored negated
+        hi = [0.]  # min heap
+        lo.pop()
+        hi.pop()
+        delayed = {0.: 0}
+        counts = np.zeros(2, dtype=np.int64)  # valid entries in lo, hi
+
+        # window for i=0
+        for j in range(1, min(halfwin, n)):
+            if not mask[j, col]:
+                _heapadd(values[j, col], lo, hi, delayed, counts)
+
+        for i in range(n):
+            if i > 0:
+                # window moves from [i-1-halfwin, i-1+halfwin) to [i-halfwin, i+halfwin)
+                j = i-1
+                if halfwin >= 1 and not mask[j, col]:
+                    _heapadd(values[j, col], lo, hi, delayed, counts)
+                j = i-1+halfwin
+                if halfwin >= 2 and j < n and not mask[j, col]:
+                    _heapadd(values[j, col], lo, hi, delayed, counts)
+                j = i
+                if halfwin >= 2 and not mask[j, col]:
+                    _heapremove(values[j, col], lo, hi, delayed, counts)
+                j = i-1-halfwin
+                if halfwin >= 1 and j >= 0 and not mask[j, col]:
+                    _heapremove(values[j, col], lo, hi, delayed, counts)
+
+            if counts[0] > counts[1]:
+                med[i, col] = -lo[0]
+                medmask[i, col] = False
+            elif counts[0] > 0:
+                med[i, col] = (hi[0] - lo[0])/2.
+                medmask[i, col] = False
+
+    return med, medmask
+
+
+@jit(nogil=True, nopython=True, cache=True)
+def _heapprune(heap, sign, delayed):
+    while len(heap):
+        val = sign*heap[0]
+        if delayed.get(val, 0) > 0:
+            delayed[val] -= 1
+            heapq.heappop(heap)
+        else:
+            break
+
+
+@jit(nogil=True, nopython=True, cache=True)
+def _heaprebalance(lo, hi, delayed, counts):
+    if counts[0] > counts[1] + 1:
+        heapq.heappush(hi, -heapq.heappop(lo))
+        counts[0] -= 1
+        counts[1] += 1
+        _heapprune(lo, -1., delayed)
+    elif counts[0] < counts[1]:
+        heapq.heappush(lo, -heapq.heappop(hi))
+        counts[0] += 1
+        counts[1] -= 1
+        _heapprune(hi, 1., delayed)
+
+
+@jit(nogil=True, nopython=True, cache=True)
+def _heapadd(val, lo, hi, delayed, counts):
+    if counts[0] == 0 or val <= -lo[0]:
+        heapq.heappush(lo, -val)
+        counts[0] += 1
+    else:
+        heapq.heappush(hi, val)
+        counts[1] += 1
+    _heaprebalance(lo, hi, delayed, counts)
+
+
+@jit(nogil=True, nopython=True, cache=True)
+def _heapremove(val, lo, hi, delayed, counts):
+    delayed[val] = delayed.get(val, 0) + 1
+    if val <= -lo[0]:
+        counts[0] -= 1
+        if val == -lo[0]:
+            _heapprune(lo, -1., delayed)
+    else:
+        counts[1] -= 1
+        if val == hi[0]:
+            _heapprune(hi, 1., delayed)
+    _heaprebalance(lo, hi, delayed, counts)
 
 
 def getonlineflags(st, segment):
     """ Gets antenna flags for a given segment from either sdm or mcaf server.
     Returns an array of flags (1: good, 0: bad) for each baseline.
+    For sdm, flags come from online flag table of scan (read once per state).
     """
 
     t0, t1 = st.segmenttimes[segment]
     if st.metadata.datasource == 'sdm':
-        sdm = util.getsdm(st.metadata.filename, bdfdir=st.metadata.bdfdir)
-        scan = sdm.scan(st.metadata.scan)
-        flags = scan.flags([t0, t1]).all(axis=0)
+        flags = query_onlineflagtable(st.onlineflagtable, [t0, t1]).all(axis=0)
     elif st.metadata.datasource == 'vys':
         try:
             from realfast.mcaf_servers import getblflags
@@ -178,6 +589,59 @@ def getonlineflags(st, segment):
     return flags
 
 
+def make_onlineflagtable(st, expand=1.0):
+    """ Reads sdm online flags once for the scan of state st.
+    Returns tuple (start, end, blflag) of flag intervals (in ns, widened by
+    expand seconds) overlapping the scan and a boolean table (nflag, nbl)
+    of baselines flagged in each interval. Baselines are in sdm order.
+    """
+
+    from sdmpy.scan import sdmarray
+
+    sdm = util.getsdm(st.metadata.filename, bdfdir=st.metadata.bdfdir)
+    scan = sdm.scan(st.metadata.scan)
+    ants = scan.antennas
+    baselines = scan.baselines
+    exp_ns = int(expand*1e9)
+    times = np.array(st.segmenttimes)
+    tmin = int(times.min()*86400.0e9)
+    tmax = int(times.max()*86400.0e9)
+
+    start = []
+    end = []
+    blflag = []
+    for flag in sdm['Flag']:
+        t0 = int(flag.startTime)-exp_ns
+        t1 = int(flag.endTime)+exp_ns
+        if t1 <= tmin or t0 >= tmax:
+            continue
+
+        flagants = [sdm['Antenna'][a].name for a in sdmarray(flag.antennaId)]
+        start.append(t0)
+        end.append(t1)
+        blflag.append([(ant0 in flagants) or (ant1 in flagants)
+                       for (ant0, ant1) in baselines])
+
+    logger.info('Read {0} online flag intervals for scan {1}'
+                .format(len(start), st.metadata.scan))
+
+    return (np.array(start, dtype=np.int64), np.array(end, dtype=np.int64),
+            np.array(blflag, dtype=bool).reshape(len(start), len(baselines)))
+
+
+def query_onlineflagtable(flagtable, mjd):
+    """ Get flags from table made by make_onlineflagtable at times mjd.
+    Returns array (ntimes, nbl) with 1 for good and 0 for bad, as with
+    sdmpy Scan.flags.
+    """
+
+    start, end, blflag = flagtable
+    t_ns = np.array(np.array(mjd)*86400.0e9, dtype=np.int64)
+    active = (t_ns[:, None] > start[None, :]) & (t_ns[:, None] < end[None, :])
+
+    return (~np.dot(active, blflag)).astype(int)
+
+
 def flag_data_rtpipe(st, data):
     """ Flagging data in single process
     Deprecated.
@@ -0,0 +1,102 @@
+from __future__ import print_function, division, absolute_import, unicode_literals
+from builtins import bytes, dict, object, range, map, input, str
+from future.utils import itervalues, viewitems, iteritems, listvalues, listitems
+
+import importlib
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class LazyObject(object):
+    """ Stands in for object made by factory on first attribute access.
+    Used to defer heavy imports (casa tools, plotting, etc.) until needed.
+    """
+
+    def __init__(self, factory):
+        self.__dict__['_factory'] = factory
+        self.__dict__['_obj'] = None
+        self.__dict__['_lock'] = threading.Lock()
+
+    def _load(self):
+        obj = self.__dict__['_obj']
+        if obj is None:
+            with self.__dict__['_lock']:
+                obj = self.__dict__['_obj']
+                if obj is None:
+                    obj = self.__dict__['_factory']()
+                    self.__dict__['_obj'] = obj
+        return obj
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    @property
+    def loaded(self):
+        return self.__dict__['_obj'] is not None
+
+
+def lazy_import(name):
+    """ Module that is imported on first attribute access """
+
+    return LazyObject(lambda: importlib.import_module(name))
+
+
+def casatool(name):
+    """ CASA tool (e.g., 'quanta', 'measures') created on first use """
+
+    def factory():
+        import pwkit.environments.casa.util as casautil
+        return getattr(casautil.tools, name)()
+
+    return LazyObject(factory)
+
+
+class LazyGufunc(object):
+    """ numba guvectorize function compiled on first call (or compile()).
+    Arguments are as for numba.guvectorize.
+    """
+
+    def __init__(self, func, signatures, layout, **kwargs):
+        self.func = func
+        self.signatures = signatures
+        self.layout = layout
+        self.kwargs = kwargs
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+        self._gufunc = None
+        self._lock = threading.Lock()
+
+    def compile(self):
+        """ Build gufunc, if not yet done, and return it """
+
+        if self._gufunc is None:
+            with self._lock:
+                if self._gufunc is None:
+                    from numba import guvectorize
+                    self._gufunc = guvectorize(self.signatures, self.layout,
+                                               **self.kwargs)(self.func)
+        return self._gufunc
+
+    def __call__(self, *args, **kwargs):
+        return self.compile()(*args, **kwargs)
+
+    @property
+    def compiled(self):
+        return self._gufunc is not None
+
+
+def guvectorize(signatures, layout, **kwargs):
+    """ Decorator like numba.guvectorize, but compiles on first call """
+
+    def wrapper(func):
+        return LazyGufunc(func, signatures, layout, **kwargs)
+
+    return wrapper
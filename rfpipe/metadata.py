@@ -7,13 +7,13 @@ import os.path
 import attr
 
 import numpy as np
-import pwkit.environments.casa.util as casautil
+from rfpipe import lazy
 
 import logging
 logger = logging.getLogger(__name__)
 
-qa = casautil.tools.quanta()
-me = casautil.tools.measures()
+qa = lazy.casatool('quanta')
+me = lazy.casatool('measures')
 
 
 @attr.s
@@ -25,7 +25,7 @@ class Metadata(object):
     """
 
     # basics
-    datasource = attr.ib(default=None)  # 'vys', 'sdm', 'sim', 'vyssim'
+    datasource = attr.ib(default=None)  # 'vys', 'sdm', 'sim', 'vyssim', 'replay'
     datasetId = attr.ib(default=None)
     filename = attr.ib(default=None)  # full path to SDM (optional)
     scan = attr.ib(default=None)  # int
@@ -59,9 +59,16 @@ class Metadata(object):
     spw_chansize = attr.ib(default=None)  # channel size in Hz
     pols_orig = attr.ib(default=None)
 
+    def __setattr__(self, name, value):
+        """ Count changes so State can invalidate memoized properties """
+
+        object.__setattr__(self, name, value)
+        object.__setattr__(self, '_nchange',
+                           self.__dict__.get('_nchange', 0) + 1)
+
     def atdefaults(self):
         """ Is metadata still set at default values? """
-        return not any([self.__dict__[ab] for ab in self.__dict__])
+        return not any([self.__dict__[ab.name] for ab in attr.fields(Metadata)])
 
 #    @property
 #    def spw_chanr(self):
@@ -159,15 +166,8 @@ class Metadata(object):
 
     @property
     def uvrange_orig(self):
-        from rfpipe.util import calc_uvw
-        (ur, vr, wr) = calc_uvw(datetime=self.starttime_string,
-                                     radec=self.radec,
-                                     antpos=self.antpos,
-                                     telescope=self.telescope)
-        u = ur * self.freq_orig.min() * (1e9/3e8) * (-1)
-        v = vr * self.freq_orig.min() * (1e9/3e8) * (-1)
-
-        return (u.max() - u.min(), v.max() - v.min())
+        from rfpipe.util import calc_uvrange
+        return calc_uvrange(self)
 
     @property
     def npol_orig(self):
@@ -3,6 +3,13 @@ from builtins import bytes, dict, object, range, map, input, str
 from future.utils import itervalues, viewitems, iteritems, listvalues, listitems
 from io import open
 
+import sys
+import random
+import multiprocessing
+import time
+import numpy as np
+from concurrent import futures
+
 import logging
 logger = logging.getLogger(__name__)
 vys_timeout_default = 10
@@ -12,24 +19,58 @@ def pipeline_scan(st, segments=None, cfile=None,
                   vys_timeout=vys_timeout_default, devicenum=None):
     """ Given rfpipe state run search pipline on all segments in a scan.
         state/preference has fftmode that will determine functions used here.
+        Segments are searched by st.nworkers processes (see prefs.memoryplan)
+        for sdm and sim data, so scripts must guard the call with
+        if __name__ == '__main__' when that is more than 1.
     """
 
     from rfpipe import candidates
 
     # initialize with empty cc
     candcollection = candidates.CandCollection(prefs=st.prefs,
-                                               metadata=st.metadata)
+                                               metadata=st.metadata,
+                                               snapshot=st.snapshot())
 
     if not isinstance(segments, list):
         segments = list(range(st.nsegment))
 
-    for segment in segments:
-        candcollection += pipeline_seg(st, segment, devicenum=devicenum, cfile=cfile,
-                                       vys_timeout=vys_timeout)
+    nworkers = min(st.nworkers, len(segments))
+    if nworkers > 1 and st.metadata.datasource not in ['sdm', 'sim']:
+        logger.warning("Searching {0} data with 1 worker, not {1}."
+                       .format(st.metadata.datasource, nworkers))
+        nworkers = 1
+
+    if nworkers > 1:
+        # spawn workers to avoid inheriting fftw/numba threads via fork
+        kwargs = {}
+        if sys.version_info >= (3, 7):
+            kwargs['mp_context'] = multiprocessing.get_context('spawn')
+        with futures.ProcessPoolExecutor(max_workers=nworkers,
+                                         **kwargs) as ex:
+            jobs = [ex.submit(_pipeline_seg_snapshot, st.snapshot(), segment,
+                              cfile, vys_timeout, devicenum)
+                    for segment in segments]
+            for job in jobs:
+                candcollection += job.result()
+    else:
+        for segment in segments:
+            candcollection += pipeline_seg(st, segment, devicenum=devicenum, cfile=cfile,
+                                           vys_timeout=vys_timeout)
 
     return candcollection
 
 
+def _pipeline_seg_snapshot(snapshot, segment, cfile, vys_timeout, devicenum):
+    """ Run pipeline_seg in worker process on State rebuilt from snapshot.
+    """
+
+    from rfpipe import state
+
+    st = state.State.from_snapshot(snapshot)
+    return pipeline_seg(st, segment, cfile=cfile, vys_timeout=vys_timeout,
+                        devicenum=devicenum)
+
+
 def pipeline_seg(st, segment, cfile=None, vys_timeout=vys_timeout_default, devicenum=None):
     """ Submit pipeline processing of a single segment on a single node.
     state/preference has fftmode that will determine functions used here.
@@ -40,6 +81,11 @@ def pipeline_seg(st, segment, cfile=None, vys_timeout=vys_timeout_default, devic
     data = source.read_segment(st, segment, timeout=vys_timeout, cfile=cfile)
     candcollection = prep_and_search(st, segment, data, devicenum=devicenum)
 
+    if st.metadata.datasource == 'replay':
+        from rfpipe import replay
+        logger.info("Segment {0} searched {1:.2f} s after end of window"
+                    .format(segment, replay.latency(st, segment)))
+
     return candcollection
 
 
@@ -86,3 +132,288 @@ def pipeline_sdm(sdm, inprefs=None, intent='TARGET', preffile=None):
         st = state.State(sdmfile=sdm, sdmscan=scannum, inprefs=inprefs,
                          preffile=preffile)
         ccs.append(pipeline_scan(st))
+
+
+def pipeline_campaign(stateargs, dminds, dtinds, snrs, lms=((0., 0.),),
+                      nrep=1, nworkers=1, campaignfile=None, seed=0):
+    """ Injection/recovery campaign over a grid of mock transients.
+    stateargs is dict of arguments to define State (e.g., inmeta and inprefs).
+    Grid is the product of dminds and dtinds (indices of searched dmarr and
+    dtarr), snrs and lms (list of (l, m) in radians), with nrep mocks each.
+    Scans are searched with one mock per segment and recovery found with
+    CandCollection.mock_map. Mocks are injected with width of at most 2
+    integrations, so dtinds must select dtarr values of 1 or 2.
+    Scans are distributed over nworkers processes (spawned for python>=3.7),
+    so scripts must guard the call with if __name__ == '__main__'.
+    Returns structured array per grid point with recovered fraction and mean
+    time per stage. Optionally saves summary and trials arrays to npz file
+    campaignfile (load with np.load).
+    """
+
+    from rfpipe import state
+
+    grid = [(dmind, dtind, snr, l, m) for dmind in dminds for dtind in dtinds
+            for snr in snrs for (l, m) in lms]
+    trials = [gridpoint for gridpoint in grid for rep in range(nrep)]
+
+    st = state.State(showsummary=False, **stateargs)
+    baddt = [dtind for dtind in dtinds if st.dtarr[dtind] > 2]
+    if baddt:
+        raise ValueError("Cannot inject mocks wider than 2 integrations. "
+                         "Remove dtinds {0} (dt={1})."
+                         .format(baddt, [st.dtarr[dtind] for dtind in baddt]))
+
+    jobtrials = [trials[i:i+st.nsegment]
+                 for i in range(0, len(trials), st.nsegment)]
+    logger.info("Running campaign of {0} mocks on {1} grid points in {2} scans"
+                .format(len(trials), len(grid), len(jobtrials)))
+
+    if nworkers > 1:
+        # spawn workers to avoid inheriting fftw/numba threads via fork
+        kwargs = {}
+        if sys.version_info >= (3, 7):
+            kwargs['mp_context'] = multiprocessing.get_context('spawn')
+        with futures.ProcessPoolExecutor(max_workers=nworkers,
+                                         **kwargs) as ex:
+            jobs = [ex.submit(_campaign_scan, stateargs, jobtrial, seed+i)
+                    for i, jobtrial in enumerate(jobtrials)]
+            rows = [row for job in jobs for row in job.result()]
+    else:
+        rows = [row for i, jobtrial in enumerate(jobtrials)
+                for row in _campaign_scan(stateargs, jobtrial, seed+i)]
+
+    trialarr = np.array(rows, dtype=campaign_dtype)
+
+    summary = np.zeros(len(grid), dtype=[(str('dmind'), np.int32),
+                                         (str('dtind'), np.int32),
+                                         (str('snr'), np.float32),
+                                         (str('l'), np.float64),
+                                         (str('m'), np.float64),
+                                         (str('ntrial'), np.int32),
+                                         (str('nrecovered'), np.int32),
+                                         (str('fraction'), np.float32),
+                                         (str('t_read'), np.float32),
+                                         (str('t_search'), np.float32),
+                                         (str('t_map'), np.float32)])
+    for i, (dmind, dtind, snr, l, m) in enumerate(grid):
+        sel = trialarr[(trialarr['dmind'] == dmind) &
+                       (trialarr['dtind'] == dtind) &
+                       (trialarr['snr'] == np.float32(snr)) &
+                       (trialarr['l'] == l) & (trialarr['m'] == m)]
+        summary[i] = (dmind, dtind, snr, l, m, len(sel),
+                      sel['recovered'].sum(), sel['recovered'].mean(),
+                      sel['t_read'].mean(), sel['t_search'].mean(),
+                      sel['t_map'].mean())
+        logger.info("Recovered {0}/{1} mocks at dmind {2}, dtind {3}, snr {4}, "
+                    "(l, m) = ({5}, {6})"
+                    .format(summary[i]['nrecovered'], len(sel), dmind, dtind,
+                            snr, l, m))
+
+    if campaignfile is not None:
+        with open(campaignfile, 'wb') as fp:
+            np.savez(fp, summary=summary, trials=trialarr)
+        logger.info("Wrote campaign results to {0}".format(campaignfile))
+
+    return summary
+
+
+campaign_dtype = [(str('dmind'), np.int32), (str('dtind'), np.int32),
+                  (str('snr'), np.float32), (str('l'), np.float64),
+                  (str('m'), np.float64), (str('segment'), np.int32),
+                  (str('integration'), np.int32), (str('dm'), np.float32),
+                  (str('dt'), np.float32), (str('amp'), np.float32),
+                  (str('recovered'), bool), (str('t_read'), np.float32),
+                  (str('t_search'), np.float32), (str('t_map'), np.float32)]
+
+
+def _campaign_scan(stateargs, trials, seed):
+    """ Search one scan with one mock per segment for list of trials of
+    (dmind, dtind, snr, l, m). Returns list of rows of campaign_dtype.
+    Trials with no integration to inject into in their segment are skipped.
+    """
+
+    from rfpipe import state, source, util, candidates
+
+    random.seed(seed)
+    np.random.seed(seed)
+
+    stateargs = dict(stateargs)
+    inprefs = dict(stateargs.get('inprefs') or {})
+    inprefs['simulated_transient'] = []
+    if not inprefs.get('clustercands'):
+        inprefs['clustercands'] = True
+    stateargs['inprefs'] = inprefs
+    st = state.State(showsummary=False, **stateargs)
+    takepol = [st.metadata.pols_orig.index(pol) for pol in st.pols]
+
+    candcollection = candidates.CandCollection(prefs=st.prefs,
+                                               metadata=st.metadata,
+                                               snapshot=st.snapshot())
+    rows = []
+    for segment, (dmind, dtind, snr, l, m) in enumerate(trials):
+        t0 = time.time()
+        data = source.read_segment(st, segment)
+        t1 = time.time()
+        # start mock on resampled integration boundary to match mock_map
+        ints = [i for i in st.get_search_ints(segment, dmind, dtind)
+                if not i % st.dtarr[dtind]]
+        if not ints:
+            logger.warning("No integrations to inject mock at dmind {0}, "
+                           "dtind {1} in segment {2}. Skipping trial."
+                           .format(dmind, dtind, segment))
+            continue
+        mock = util.make_transient_params(st, segment=segment, dmind=dmind,
+                                          dtind=dtind, i=random.choice(ints),
+                                          snr=snr, lm=(l, m),
+                                          data=data.take(takepol, axis=3).take(st.chans, axis=2))[0]
+        st.prefs.simulated_transient = st.prefs.simulated_transient + [mock]
+        t2 = time.time()
+        candcollection += prep_and_search(st, segment, data)
+        t3 = time.time()
+        rows.append([dmind, dtind, snr, l, m] + list(mock[:5]) +
+                     [False, t1-t0, t3-t2, 0.])
+
+    if not rows:
+        return []
+
+    t0 = time.time()
+    candcollection.prefs.simulated_transient = st.prefs.simulated_transient
+    if len(candcollection):
+        map_mocks, mock_labels = candcollection.mock_map
+    else:
+        mock_labels = [-2]*len(rows)
+    t_map = (time.time()-t0)/len(rows)
+
+    for row, label in zip(rows, mock_labels):
+        row[10] = label != -2
+        row[13] = t_map
+
+    return [tuple(row) for row in rows]
+
+
+def pipeline_warmup(inprefs=None, nants=5, nspw=2, nchan=64, nints=60):
+    """ Compile numba kernels before first segment of a scan.
+    Searches a small simulated segment with given preferences, so kernels
+    are built for the dtypes and layouts used by pipeline. Kernels with
+    cache=True are loaded from the numba cache when it is valid for installed
+    numba/rfpipe and compiled (and cache rewritten) otherwise. Parallel
+    gufuncs are compiled when nthread>1.
+    Returns summary array with compile time, cache hits/misses for each
+    kernel compiled in this process. Summary is empty if numba jit is
+    disabled (NUMBA_DISABLE_JIT=1), since there is nothing to compile.
+    """
+
+    import numba
+    from rfpipe import state, metadata, lazy
+
+    if numba.config.DISABLE_JIT:
+        logger.info("numba jit disabled. Skipping warm-up.")
+        return np.array([], dtype=warmup_dtype)
+
+    try:
+        from numba.core import event
+    except ImportError:
+        event = None
+
+    inprefs = dict(inprefs) if inprefs is not None else {}
+    inprefs.update({'dmarr': [0, 100], 'dtarr': [1, 2], 'npix_max': 64,
+                    'segmenttimes': None, 'simulated_transient': 1, 'gainfile': None,
+                    'savenoise': False, 'savecandcollection': False,
+                    'savecanddata': False, 'saveplots': False,
+                    'savesols': False})
+    t0 = 58000.
+    meta = metadata.mock_metadata(t0, t0+nints*5e-3/(24*3600), nants, nspw,
+                                  nchan, 4, 5e3, datasource='sim')
+    st = state.State(inmeta=meta, inprefs=inprefs, showsummary=False)
+
+    kernels = _numba_kernels()
+    names = dict([(id(kernel), name) for name, kernel in iteritems(kernels)])
+    times = dict.fromkeys(kernels, 0.)
+
+    t1 = time.time()
+    if st.prefs.nthread > 1:
+        for name, kernel in iteritems(kernels):
+            if isinstance(kernel, lazy.LazyGufunc) and not kernel.compiled:
+                t2 = time.time()
+                kernel.compile()
+                times[name] = time.time() - t2
+
+    if event is not None:
+        with event.install_recorder("numba:compile") as rec:
+            _warmup_run(st)
+
+        # pair start/end of (possibly nested) compile events per kernel
+        starts = {}
+        for ts, ev in rec.buffer:
+            name = names.get(id(ev.data['dispatcher']))
+            if name is None:
+                continue
+            if ev.is_start:
+                starts.setdefault(name, []).append(ts)
+            elif starts.get(name):
+                times[name] += ts - starts[name].pop()
+    else:
+        _warmup_run(st)
+    t_total = time.time() - t1
+
+    rows = []
+    for name, kernel in iteritems(kernels):
+        if isinstance(kernel, lazy.LazyGufunc):
+            if kernel.compiled:
+                rows.append((name, len(kernel.signatures), times[name], -1, -1))
+        elif kernel.signatures:
+            stats = kernel.stats
+            rows.append((name, len(kernel.signatures),
+                         times[name] if event is not None else np.nan,
+                         sum(stats.cache_hits.values()),
+                         sum(stats.cache_misses.values())))
+    summary = np.array(rows, dtype=warmup_dtype)
+
+    logger.info("Warmed up {0} kernels in {1:.1f} s:".format(len(rows),
+                                                             t_total))
+    for row in summary:
+        logger.info("\t {0}: {1} signature(s), {2:.2f} s, cache hits/misses "
+                    "{3}/{4}".format(*row))
+    stale = summary['kernel'][summary['misses'] > 0]
+    if len(stale):
+        logger.warning("numba cache missing or invalid for {0}. Compiled and "
+                       "rewrote cache.".format(', '.join(stale)))
+
+    return summary
+
+
+warmup_dtype = [(str('kernel'), 'U40'), (str('nsig'), np.int32),
+                (str('seconds'), np.float64), (str('hits'), np.int32),
+                (str('misses'), np.int32)]
+
+
+def _numba_kernels():
+    """ Returns dict of name to numba dispatcher or lazy gufunc for all
+    kernels in rfpipe modules used by pipeline.
+    """
+
+    try:
+        from numba.core.registry import CPUDispatcher
+    except ImportError:
+        from numba.targets.registry import CPUDispatcher  # numba<0.49
+    from rfpipe import util, search, flagging, calibration, lazy
+
+    kernels = {}
+    for module in [util, search, flagging, calibration]:
+        for name, obj in iteritems(vars(module)):
+            if isinstance(obj, (lazy.LazyGufunc, CPUDispatcher)):
+                kernels[name] = obj
+
+    return kernels
+
+
+def _warmup_run(st):
+    """ Read, prep and search first segment of warm-up state """
+
+    from rfpipe import source
+
+    data = source.read_segment(st, 0)
+    if st.prefs.fftmode == 'fftw':
+        return prep_and_search(st, 0, data)
+    else:
+        return source.data_prep(st, 0, data)
@@ -0,0 +1,180 @@
+from __future__ import print_function, division, absolute_import, unicode_literals
+from builtins import bytes, dict, object, range, map, input, str
+from future.utils import itervalues, viewitems, iteritems, listvalues, listitems
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+# The planner sets State.segmenttimes and State.nworkers when
+# prefs.memoryplan > 0 and pipeline_scan uses that many worker processes.
+# Otherwise State scales segments by immem+vismem and this module can be
+# used to check a plan.
+
+toGB = 1/1000**3
+
+# Memory held at peak of each pipeline stage in units of buffers per segment:
+# raw (complex64 as read), prep (complex64 after pol/chan selection),
+# mask (bool flags of prep), image (grids, complex fft output and real
+# images for all integrations at one dm/dt).
+# Calibrated with measure_model on simulated data. Flagging statistics make
+# several temporary copies, so it usually sets the peak.
+memorymodel = {'fftw': (('read', {'raw': 1.5}),
+                        ('data_prep', {'raw': 2, 'prep': 2}),
+                        ('flag', {'raw': 1, 'prep': 6.5, 'mask': 1}),
+                        ('dedisperseresample', {'raw': 1, 'prep': 2}),
+                        ('image', {'raw': 1, 'prep': 3, 'image': 1})),
+               'cuda': (('read', {'raw': 1.5}),
+                        ('data_prep', {'raw': 2, 'prep': 2}),
+                        ('flag', {'raw': 1, 'prep': 6.5, 'mask': 1}),
+                        ('search', {'raw': 1, 'prep': 1.5}))}
+
+plan_dtype = np.dtype([(str('segment'), '<i4'), (str('readints'), '<i4'),
+                       (str('stage'), 'U20'), (str('peak'), '<f8')])
+
+
+def unit_bytes(st, readints):
+    """ Size in bytes of each memory model unit for segment of readints """
+
+    nint = readints//st.prefs.read_tdownsample
+    nprep = nint*st.nbl*(st.nchan//st.prefs.read_fdownsample)*st.npol
+    nraw = (readints*st.metadata.nbl_orig*st.metadata.nchan_orig *
+            st.metadata.npol_orig)
+
+    return {'raw': 8*nraw, 'prep': 8*nprep, 'mask': nprep,
+            'image': 20*nint*st.npixx*st.npixy}
+
+
+def stage_memory(st, readints, model=None):
+    """ Predicted memory (in GB) at peak of each stage for segment of
+    readints. model is tuple of (stage, units) (default from memorymodel
+    for st.fftmode).
+    Returns list of (stage, GB).
+    """
+
+    if model is None:
+        model = memorymodel[st.fftmode]
+
+    unitb = unit_bytes(st, readints)
+    return [(stage, toGB*sum([mult*unitb[unit]
+                              for (unit, mult) in iteritems(units)]))
+            for (stage, units) in model]
+
+
+def segment_readints(st, segmenttimes):
+    """ Number of integrations read in each segment """
+
+    segmenttimes = np.array(segmenttimes)
+    return np.round(24*3600*(segmenttimes[:, 1] - segmenttimes[:, 0]) /
+                    st.inttime).astype(int)
+
+
+def summarize_plan(st, segmenttimes, model=None):
+    """ Predicted peak memory of a worker for each segment.
+    Returns array of plan_dtype with stage at peak and peak (in GB).
+    """
+
+    readints = segment_readints(st, segmenttimes)
+    summary = np.zeros(len(readints), dtype=plan_dtype)
+    for segment, ri in enumerate(readints):
+        stage, peak = max(stage_memory(st, ri, model=model),
+                          key=lambda sm: sm[1])
+        summary[segment] = (segment, ri, stage, peak)
+
+    return summary
+
+
+def plan_segments(st, nworkers=1, memory_limit=None, model=None):
+    """ Pick segmenttimes and number of workers that fit in memory_limit
+    (in GB; default st.prefs.memory_limit) with nworkers processing segments
+    concurrently. Segments are shortened from fringe time until they fit,
+    then worker count is reduced if shortest segments do not fit.
+    prefs.segmenttimes, if set, are kept as is.
+    Returns (segmenttimes, nworkers, summary) with summary as from
+    summarize_plan. State uses this plan for segmenttimes and nworkers when
+    prefs.memoryplan is set to the number of workers.
+    """
+
+    from rfpipe import util
+
+    if memory_limit is None:
+        memory_limit = st.prefs.memory_limit
+
+    if st.prefs.segmenttimes is not None:
+        segmenttimes = np.array(st.prefs.segmenttimes)
+        summary = summarize_plan(st, segmenttimes, model=model)
+    else:
+        minints = int(round(st.t_overlap/st.inttime)) + 1
+        scale_nsegment = 1.
+        segmenttimes = util.calc_segment_times(st, scale_nsegment)
+        summary = summarize_plan(st, segmenttimes, model=model)
+        while (nworkers*summary['peak'].max() > memory_limit and
+               summary['readints'].max() > minints):
+            scale_nsegment *= nworkers*summary['peak'].max()/memory_limit
+            segmenttimes = util.calc_segment_times(st, scale_nsegment)
+            summary = summarize_plan(st, segmenttimes, model=model)
+
+    peak = summary['peak'].max()
+    if peak > memory_limit:
+        raise ValueError('memory_limit of {0} GB is smaller than predicted '
+                         'peak of {1:.3f} GB for single worker.'
+                         .format(memory_limit, peak))
+    nworkers = max(1, min(nworkers, int(memory_limit//peak)))
+
+    logger.info('Planned {0} segments of {1} ints for {2} worker{3}. '
+                'Predicted peak memory {4:.3f} GB per worker ({5}).'
+                .format(len(segmenttimes), summary['readints'].max(),
+                        nworkers, 's'[not nworkers-1:], peak,
+                        summary['stage'][summary['peak'].argmax()]))
+
+    return segmenttimes, nworkers, summary
+
+
+def measure_model(st, segment=0, data=None):
+    """ Measure peak memory of each stage on segment with tracemalloc.
+    Data is read, if not provided. Returns model (as in memorymodel) in
+    units of raw buffers for use in stage_memory or plan_segments.
+    """
+
+    import tracemalloc
+    from rfpipe import source, flagging, search, util
+
+    def measure(func, *args, **kwargs):
+        tracemalloc.start()
+        try:
+            result = func(*args, **kwargs)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        return result, peak
+
+    if data is None:
+        data, readpeak = measure(source.read_segment, st, segment)
+    else:
+        readpeak = data.nbytes
+    rawbytes = float(data.nbytes)
+
+    takepol = [st.metadata.pols_orig.index(pol) for pol in st.pols]
+    datap, peak = measure(
+        lambda: np.nan_to_num(np.require(data, requirements='W')
+                              .take(takepol, axis=3).take(st.chans, axis=2)))
+    stages = [('read', readpeak), ('data_prep', rawbytes + peak)]
+
+    _, peak = measure(flagging.flag_data, st, datap)
+    stages.append(('flag', rawbytes + datap.nbytes + peak))
+
+    delay = st.delaytable[-1]
+    data_corr, peak = measure(search.dedisperseresample, datap, delay, 1,
+                              parallel=st.prefs.nthread > 1,
+                              resamplefirst=st.fftmode == 'cuda')
+    stages.append(('dedisperseresample', rawbytes + datap.nbytes + peak))
+
+    if st.fftmode == 'fftw':
+        uvw = util.get_uvw_segment(st, segment)
+        _, peak = measure(search.grid_image, data_corr, uvw, st.npixx,
+                          st.npixy, st.uvres, 'fftw', st.prefs.nthread)
+        stages.append(('image', rawbytes + datap.nbytes + data_corr.nbytes +
+                       peak))
+
+    return tuple([(stage, {'raw': peak/rawbytes}) for (stage, peak) in stages])
@@ -43,11 +43,13 @@ class Preferences(object):
     read_fdownsample = attr.ib(default=1)
     l0 = attr.ib(default=0.)  # in radians
     m0 = attr.ib(default=0.)  # in radians
-    timesub = attr.ib(default=None)
+    uvwbackend = attr.ib(default='casa')  # 'casa' measures or 'numpy' (no lock, ~1e-4 of bl length)
+    timesub = attr.ib(default=None)  # 'mean', 'median' or 'sigmaclip'
     flaglist = attr.ib(default=[('badchtslide', 4., 20),
                                 ('badchtslide', 4., 20),
                                 ('badspw', 3.),
                                 ('blstd', 3., 0.008)])
+    flagparallel = attr.ib(default=False)  # flag per spw/pol with nthread threads
     ignore_spwedge = attr.ib(default=0.075)  # fraction of each spw edge to ignore when selecting data
     flagantsol = attr.ib(default=True)
     badspwpol = attr.ib(default=2.)  # 0 means no flagging done
@@ -59,12 +61,15 @@ class Preferences(object):
     # values/units: (segment, i0/int, dm/pc/cm3, dt/s, amp/sys, dl/rad, dm/rad)
     # or an int that defines number of mocks to create per scan
     simulated_transient = attr.ib(default=None)
+    simulated_rfi = attr.ib(default=None)  # (nchan, nint, amp) for persistent channel and broadband rfi (amp in noise units)
+    simulated_gain = attr.ib(default=False)  # apply random antenna bandpass/delay to simulated data
 
     # processing
     nthread = attr.ib(default=1)
 #    nsegment = attr.ib(default=0)
     segmenttimes = attr.ib(default=None)  # list of lists of float pairs
     memory_limit = attr.ib(default=16)  # in GB; includes typical freqs/configs
+    memoryplan = attr.ib(default=0)  # if >0, plan segmenttimes with planner for this many concurrent workers
     maximmem = attr.ib(default=16)  # in GB; defines chunk for fftw imaging
 
     # search
@@ -102,13 +107,40 @@ class Preferences(object):
 #    logfile = attr.ib(default=True)
     loglevel = attr.ib(default='INFO')
 
+    def __setattr__(self, name, value):
+        """ Count changes so State can invalidate memoized properties.
+        Change count also versions the cached json/name/contentid.
+        """
+
+        object.__setattr__(self, name, value)
+        object.__setattr__(self, '_nchange',
+                           self.__dict__.get('_nchange', 0) + 1)
+
+    def _cached(self, key, func):
+        """ Value of func cached until next attribute set.
+        In-place changes (e.g., appending to a list) are not seen.
+        """
+
+        nchange = self.__dict__.get('_nchange', 0)
+        cache = self.__dict__.get('_hashcache')
+        if cache is None or cache[0] != nchange:
+            cache = (nchange, {})
+            self.__dict__['_hashcache'] = cache  # does not count as change
+
+        if key not in cache[1]:
+            cache[1][key] = func()
+
+        return cache[1][key]
+
     @property
     def ordered(self):
         """ Get OrderedDict of preferences sorted by key
         Excludes "gainfile", since that changes with each datasetId
+        Private attributes (e.g., change count) are left out. Attributes
+        missing from older pickles are left out, too.
         """
 
-        keys = sorted(self.__dict__)
+        keys = sorted([key for key in self.__dict__ if not key.startswith('_')])
         return OrderedDict([(key, self.__dict__[key]) for key in keys])
 
     @property
@@ -117,11 +149,14 @@ class Preferences(object):
         "gainfile" and "simulated_transient" are ignored in json/name properties.
         """
 
-        excludekeys = ["gainfile", "simulated_transient"]
-        ordered2 = OrderedDict([(key, value)
-                                for (key, value) in self.ordered.items()
-                                if key not in excludekeys])
-        return json.dumps(ordered2).encode('utf-8')
+        def calc():
+            excludekeys = ["gainfile", "simulated_transient"]
+            ordered2 = OrderedDict([(key, value)
+                                    for (key, value) in self.ordered.items()
+                                    if key not in excludekeys])
+            return json.dumps(ordered2).encode('utf-8')
+
+        return self._cached('json', calc)
 
     @property
     def name(self):
@@ -129,7 +164,18 @@ class Preferences(object):
         To be used to look up preference set for a given candidate or data set.
         """
 
-        return hashlib.md5(self.json).hexdigest()
+        return self._cached('name', lambda: hashlib.md5(self.json).hexdigest())
+
+    @property
+    def contentid(self):
+        """ Content-addressed id of all preferences (including gainfile and
+        simulated_transient). Key for caches of products that depend on prefs.
+        """
+
+        return self._cached('contentid',
+                            lambda: hashlib.sha1(json.dumps(self.ordered,
+                                                            default=str)
+                                                 .encode('utf-8')).hexdigest())
 
 
 def parsejson(jsonstring):
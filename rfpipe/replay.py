@@ -0,0 +1,161 @@
+from __future__ import print_function, division, absolute_import, unicode_literals
+from builtins import bytes, dict, object, range, map, input, str
+from future.utils import itervalues, viewitems, iteritems, listvalues, listitems
+
+import threading
+import time
+import numpy as np
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import logging
+logger = logging.getLogger(__name__)
+
+# unix time of scan start per (datasetId, scan) for replayed scans
+_replaystart = {}
+
+
+def start(st, t0=None):
+    """ Set wall-clock (unix) time t0 at which replay of scan starts.
+    Default is now. Integration i of scan is then available at
+    t0 + (i+1)*inttime.
+    """
+
+    if t0 is None:
+        t0 = time.time()
+    _replaystart[(st.metadata.datasetId, st.metadata.scan)] = t0
+    logger.info("Replaying {0} scan {1} from unix time {2}"
+                .format(st.metadata.datasetId, st.metadata.scan, t0))
+
+
+def windowtimes(st, segment):
+    """ Wall-clock (unix) time of start and end of segment in replay.
+    Replay starts implicitly with first window read, if not started already.
+    """
+
+    key = (st.metadata.datasetId, st.metadata.scan)
+    t0, t1 = (24*3600*(st.segmenttimes[segment] - st.metadata.starttime_mjd))
+    if key not in _replaystart:
+        start(st, time.time() - t0)
+
+    return _replaystart[key] + t0, _replaystart[key] + t1
+
+
+def latency(st, segment):
+    """ Seconds since end of segment window in replay clock """
+
+    return time.time() - windowtimes(st, segment)[1]
+
+
+class Reader(object):
+    """ Mimics vysmaw_reader.Reader for a replayed scan.
+    Integrations of segment are pushed from a producer thread onto a queue at
+    the time they would be available from correlator. Like vysmaw, integrations
+    sent before reader opens, those that overflow queue of size maxqueue, and
+    those that arrive after window end plus offset (or after timeout multiple
+    of read time) are dropped. Data is read from sdm (if bdf defined) or
+    simulated when reader is created, so the producer thread only paces.
+    """
+
+    def __init__(self, st, segment, timeout=10, offset=4, maxqueue=None):
+        self.st = st
+        self.segment = segment
+        self.timeout = timeout
+        self.offset = offset
+        self.maxqueue = maxqueue if maxqueue is not None else st.readints
+        self.ndropped = 0
+        self._queue = None
+        self._stop = threading.Event()
+        self._thread = None
+
+        from rfpipe import source
+
+        # read before window is set, so implicit replay start excludes it
+        if st.metadata.bdfstr:
+            self._data = source.read_bdf_segment(st, segment)
+        else:
+            self._data = source.simulate_segment(st)
+        self.t0, self.t1 = windowtimes(st, segment)
+
+    def __enter__(self):
+        self.topen = time.time()
+        if self.topen > self.t1 + self.offset:
+            logger.info("Opening reader {0:.2f} s after window end. "
+                        "Skipping segment {1}."
+                        .format(self.topen - self.t1, self.segment))
+            return None
+
+        self._queue = queue.Queue(maxsize=self.maxqueue)
+        self._thread = threading.Thread(target=self._produce)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _produce(self):
+        """ Send each integration at wall-clock time it ends """
+
+        data = self._data
+        inttime = self.st.inttime
+        for i in range(len(data)):
+            tint = self.t0 + (i+1)*inttime
+            if tint < self.topen:
+                continue
+
+            wait = tint - time.time()
+            if wait > 0 and self._stop.wait(wait):
+                break
+
+            try:
+                self._queue.put_nowait((i, data[i]))
+            except queue.Full:
+                pass
+
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def readwindow(self):
+        """ Collect integrations until window closes.
+        Returns data with missing integrations set to zero or None if nothing
+        received.
+        """
+
+        deadline = min(self.t1 + self.offset,
+                       self.topen + self.timeout*(self.t1-self.t0))
+        data = np.zeros(self.st.datashape_orig, dtype='complex64')
+        received = np.zeros(len(data), dtype=bool)
+
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+
+            if item is None:
+                break
+            i, spec = item
+            data[i] = spec
+            received[i] = True
+
+        self._stop.set()
+        self.ndropped = len(data) - received.sum()
+        if self.ndropped:
+            logger.info("Dropped {0}/{1} integrations in segment {2}"
+                        .format(self.ndropped, len(data), self.segment))
+
+        if received.any():
+            return data
+        else:
+            return None
@@ -6,10 +6,12 @@ from io import open
 import pickle
 import os.path
 import numpy as np
-from kalman_detector import kalman_prepare_coeffs, kalman_significance
+from rfpipe import lazy
 import logging
 logger = logging.getLogger(__name__)
 
+kalman_detector = lazy.lazy_import('kalman_detector')
+
 
 def oldcands_read(candsfile, sdmscan=None):
     """ Read old-style candfile and create new-style candcollection
@@ -120,7 +122,8 @@ def oldcands_readone(candsfile, scan=None):
     features = np.zeros(len(loc), dtype=dtype)
     for i in range(len(loc)):
         features[i] = tuple(list(loc[i]) + list(prop[i]))
-    cc = candidates.CandCollection(features, st.prefs, st.metadata)
+    cc = candidates.CandCollection(features, st.prefs, st.metadata,
+                                   snapshot=st.snapshot())
 
     return st, cc
 
@@ -134,12 +137,40 @@ def oldcands_convert(candsfile, scan=None):
         pickle.dump(cc, pkl)
 
 
+def _tostate(st):
+    """ Return State for st, which can be a State or state.Snapshot """
+
+    from rfpipe import state
+
+    if isinstance(st, state.Snapshot):
+        st = state.State.from_snapshot(st)
+
+    return st
+
+
+def _dmdelay(st, dmind):
+    """ Delay per channel (in integrations) for dmind with scale used by
+    version of pipeline that detected candidates (see st.dmscale).
+    """
+
+    from rfpipe import util
+
+    if st.dmscale is None:
+        return st.delaytable[dmind]
+    else:
+        return util.calc_delay(st.freq, st.freq.max(), st.dmarr[dmind],
+                               st.inttime, scale=st.dmscale)
+
+
 def pipeline_dataprep(st, candloc):
     """ Prepare (read, cal, flag) data for a given state and candloc.
+    State can also be given as a state.Snapshot (e.g., from st.snapshot()).
     """
 
     from rfpipe import source
 
+    st = _tostate(st)
+
     segment, candint, dmind, dtind, beamnum = candloc
 
     # propagate through to new candcollection
@@ -158,21 +189,15 @@ def pipeline_datacorrect(st, candloc, data_prep=None):
     Can optionally pass in prepared (flagged, calibrated) data, if available.
     """
 
-    from rfpipe import util
     import rfpipe.search
 
+    st = _tostate(st)
     if data_prep is None:
         data_prep = pipeline_dataprep(st, candloc)
 
     segment, candint, dmind, dtind, beamnum = candloc
     dt = st.dtarr[dtind]
-    dm = st.dmarr[dmind]
-
-    scale = None
-    if hasattr(st, "rtpipe_version"):
-        scale = 4.2e-3 if st.rtpipe_version <= 1.54 else None
-    delay = util.calc_delay(st.freq, st.freq.max(), dm, st.inttime,
-                            scale=scale)
+    delay = _dmdelay(st, dmind)
 
     data_dmdt = rfpipe.search.dedisperseresample(data_prep, delay, dt,
                                                  parallel=st.prefs.nthread > 1,
@@ -192,6 +217,7 @@ def pipeline_canddata(st, candloc, data_dmdt=None, cpuonly=False, sig_ts=None,
     from rfpipe import candidates, util
     import rfpipe.search
 
+    st = _tostate(st)
     segment, candint, dmind, dtind, beamnum = candloc
     dt = st.dtarr[dtind]
     dm = st.dmarr[dmind]
@@ -212,7 +238,7 @@ def pipeline_canddata(st, candloc, data_dmdt=None, cpuonly=False, sig_ts=None,
             logger.warning("spectrum std all zeros. Not estimating coeffs.")
             kalman_coeffs = []
         else:
-            sig_ts, kalman_coeffs = kalman_prepare_coeffs(spec_std)
+            sig_ts, kalman_coeffs = kalman_detector.kalman_prepare_coeffs(spec_std)
 
         if not np.all(np.nan_to_num(sig_ts)):
             kalman_coeffs = []
@@ -233,7 +259,7 @@ def pipeline_canddata(st, candloc, data_dmdt=None, cpuonly=False, sig_ts=None,
     spec = data_dmdt.real.mean(axis=3).mean(axis=1)[candloc[1]]
 
     if 'snrk' in st.features:
-        significance_kalman = -kalman_significance(spec, spec_std,
+        significance_kalman = -kalman_detector.kalman_significance(spec, spec_std,
                                                    sig_ts=sig_ts,
                                                    coeffs=kalman_coeffs)
         snrk = (2*significance_kalman)**0.5
@@ -254,6 +280,7 @@ def pipeline_candidate(st, candloc, canddata=None):
 
     from rfpipe import candidates
 
+    st = _tostate(st)
     segment, candint, dmind, dtind, beamnum = candloc
 
     if canddata is None:
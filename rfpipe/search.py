@@ -4,9 +4,8 @@ from future.utils import itervalues, viewitems, iteritems, listvalues, listitems
 from io import open
 
 import numpy as np
-from numba import jit, guvectorize, int64
-import pyfftw
-from kalman_detector import kalman_prepare_coeffs, kalman_significance
+from numba import jit, int64
+from rfpipe import lazy
 from concurrent import futures
 from itertools import cycle
 from threading import Lock
@@ -14,6 +13,9 @@ from threading import Lock
 import logging
 logger = logging.getLogger(__name__)
 
+pyfftw = lazy.lazy_import('pyfftw')
+kalman_detector = lazy.lazy_import('kalman_detector')
+
 try:
     import rfgpu
 except ImportError:
@@ -44,7 +46,8 @@ def dedisperse_search_cuda(st, segment, data, devicenum=None):
         if not anydata:
             logger.info("Data is all zeros. Skipping search.")
         return candidates.CandCollection(prefs=st.prefs,
-                                         metadata=st.metadata)
+                                         metadata=st.metadata,
+                                         snapshot=st.snapshot())
 
     if isinstance(devicenum, int):
         devicenums = (devicenum,)
@@ -124,7 +127,7 @@ def dedisperse_search_cuda(st, segment, data, devicenum=None):
             logger.warning("spectrum std all zeros. Not estimating coeffs.")
             kalman_coeffs = []
         else:
-            sig_ts, kalman_coeffs = kalman_prepare_coeffs(spec_std)
+            sig_ts, kalman_coeffs = kalman_detector.kalman_prepare_coeffs(spec_std)
 
         if not np.all(np.nan_to_num(sig_ts)):
             kalman_coeffs = []
@@ -132,7 +135,8 @@ def dedisperse_search_cuda(st, segment, data, devicenum=None):
         if not np.all(sig_ts):
             logger.info("sig_ts all zeros. Skipping search.")
             return candidates.CandCollection(prefs=st.prefs,
-                                             metadata=st.metadata)
+                                             metadata=st.metadata,
+                                             snapshot=st.snapshot())
     else:
         spec_std, sig_ts, kalman_coeffs = None, None, None
 
@@ -210,8 +214,7 @@ def rfgpu_gridimage(st, segment, grid, image, vis_raw, vis_grid, img_grid,
     beamnum = 0
     candlocs, l1s, m1s, snr1s, immax1s, snrks = [], [], [], [], [], []
     for dmind in dminds:
-        delay = util.calc_delay(st.freq, st.freq.max(), st.dmarr[dmind],
-                                st.inttime)
+        delay = st.delaytable[dmind]
         integrations = st.get_search_ints(segment, dmind, dtind)
 
         if len(integrations) != 0:
@@ -267,7 +270,7 @@ def rfgpu_gridimage(st, segment, grid, image, vis_raw, vis_grid, img_grid,
 
                         # TODO: this significance can be biased low if averaging in long baselines that are not phased well
                         # TODO: spec should be calculated from baselines used to measure l,m?
-                        significance_kalman = -kalman_significance(spec,
+                        significance_kalman = -kalman_detector.kalman_significance(spec,
                                                                    spec_std,
                                                                    sig_ts=sig_ts,
                                                                    coeffs=kalman_coeffs)
@@ -309,7 +312,8 @@ def dedisperse_search_fftw(st, segment, data, wisdom=None):
         if not anydata:
             logger.info("Data is all zeros. Skipping search.")
         return candidates.CandCollection(prefs=st.prefs,
-                                         metadata=st.metadata)
+                                         metadata=st.metadata,
+                                         snapshot=st.snapshot())
 
     # some prep if kalman significance is needed
     if 'snrk' in st.features:
@@ -323,7 +327,7 @@ def dedisperse_search_fftw(st, segment, data, wisdom=None):
             logger.warning("spectrum std all zeros. Not estimating coeffs.")
             kalman_coeffs = []
         else:
-            sig_ts, kalman_coeffs = kalman_prepare_coeffs(spec_std)
+            sig_ts, kalman_coeffs = kalman_detector.kalman_prepare_coeffs(spec_std)
 
         if not np.all(np.nan_to_num(sig_ts)):
             kalman_coeffs = []
@@ -357,8 +361,7 @@ def dedisperse_search_fftw(st, segment, data, wisdom=None):
                                 st.npixy, st.uvres))
 
             # correct data
-            delay = util.calc_delay(st.freq, st.freq.max(), st.dmarr[dmind],
-                                    st.inttime)
+            delay = st.delaytable[dmind]
             data_corr = dedisperseresample(data, delay, st.dtarr[dtind],
                                            parallel=st.prefs.nthread > 1,
                                            resamplefirst=False)
@@ -383,7 +386,7 @@ def dedisperse_search_fftw(st, segment, data, wisdom=None):
                             spec = spec[0].real.mean(axis=2).mean(axis=0)
                             # TODO: this significance can be biased low if averaging in long baselines that are not phased well
                             # TODO: spec should be calculated from baselines used to measure l,m?
-                            significance_kalman = -kalman_significance(spec,
+                            significance_kalman = -kalman_detector.kalman_significance(spec,
                                                                        spec_std,
                                                                        sig_ts=sig_ts,
                                                                        coeffs=kalman_coeffs)
@@ -492,7 +495,8 @@ def reproduce_candcollection(cc, data, wisdom=None, spec_std=None, sig_ts=None,
 
     # set up output cc
     st = cc.state
-    cc1 = candidates.CandCollection(prefs=st.prefs, metadata=st.metadata)
+    cc1 = candidates.CandCollection(prefs=st.prefs, metadata=st.metadata,
+                                    snapshot=st.snapshot())
 
     if len(cc):
         candlocs = cc.locs
@@ -541,7 +545,7 @@ def reproduce_candcollection(cc, data, wisdom=None, spec_std=None, sig_ts=None,
                 else:  # if desired, but not yet calculated
                     if feature == 'snrk':
                         spec = data_corr.real.mean(axis=3).mean(axis=1)[candloc[1]]
-                        significance_kalman = -kalman_significance(spec,
+                        significance_kalman = -kalman_detector.kalman_significance(spec,
                                                                    spec_std,
                                                                    sig_ts=sig_ts,
                                                                    coeffs=kalman_coeffs)
@@ -673,9 +677,9 @@ def _grid_visibilities_jit(data, u, v, w, npixx, npixy, uvres, grids):
     return grids
 
 
-@guvectorize([str("void(complex64[:,:,:], float32[:,:], float32[:,:], float32[:,:], int64, int64, int64, complex64[:,:])")],
-             str("(n,m,l),(n,m),(n,m),(n,m),(),(),(),(o,p)"),
-             target='parallel', nopython=True)
+@lazy.guvectorize([str("void(complex64[:,:,:], float32[:,:], float32[:,:], float32[:,:], int64, int64, int64, complex64[:,:])")],
+                  str("(n,m,l),(n,m),(n,m),(n,m),(),(),(),(o,p)"),
+                  target='parallel', nopython=True, cache=True)
 def _grid_visibilities_gu(data, us, vs, ws, npixx, npixy, uvres, grid):
     b""" Grid visibilities into rounded uv coordinates for multiple cores"""
 
@@ -737,8 +741,8 @@ def _dedisperse_jit(data, delay, result):
                     result[i, j, k, l] = data[iprime, j, k, l]
 
 
-@guvectorize([str("void(complex64[:,:,:], int64[:])")], str("(n,m,l),(m)"),
-             target='parallel', nopython=True)
+@lazy.guvectorize([str("void(complex64[:,:,:], int64[:])")], str("(n,m,l),(m)"),
+                  target='parallel', nopython=True, cache=True)
 def _dedisperse_gu(data, delay):
     b""" Multicore dedispersion via numpy broadcasting.
     Requires that data be in axis order (nbl, nint, nchan, npol), so typical
@@ -794,8 +798,8 @@ def _resample_jit(data, dt, result):
                     result[i, j, k, l] = result[i, j, k, l]/dt
 
 
-@guvectorize([str("void(complex64[:], int64)")], str("(n),()"),
-             target="parallel", nopython=True)
+@lazy.guvectorize([str("void(complex64[:], int64)")], str("(n),()"),
+                  target="parallel", nopython=True, cache=True)
 def _resample_gu(data, dt):
     b""" Multicore resampling via numpy broadcasting.
     Requires that data be in nint axisto be last, so input
@@ -869,8 +873,9 @@ def _dedisperseresample_jit(data, delay, dt, result):
     return result
 
 
-@guvectorize([str("void(complex64[:,:,:], int64[:], int64)")],
-             str("(n,m,l),(m),()"), target="parallel", nopython=True)
+@lazy.guvectorize([str("void(complex64[:,:,:], int64[:], int64)")],
+                  str("(n,m,l),(m),()"), target="parallel", nopython=True,
+                  cache=True)
 def _dedisperseresample_gu(data, delay, dt):
 
     if delay.max() > 0 or dt > 1:
@@ -924,7 +929,7 @@ def search_thresh_armk(st, data, uvw, integrations=None, spec_std=None,
             logger.warning("spectrum std all zeros. Not estimating coeffs.")
             kalman_coeffs = []
         else:
-            sig_ts, kalman_coeffs = kalman_prepare_coeffs(spec_std)
+            sig_ts, kalman_coeffs = kalman_detector.kalman_prepare_coeffs(spec_std)
 
         if not np.all(np.nan_to_num(sig_ts)):
             kalman_coeffs = []
@@ -990,7 +995,7 @@ def search_thresh_armk(st, data, uvw, integrations=None, spec_std=None,
                                  peaky)
                 util.phase_shift(spec, uvw, l, m)
                 spec = spec[0].real.mean(axis=2).mean(axis=0)
-                significance_kalman = -kalman_significance(spec, spec_std,
+                significance_kalman = -kalman_detector.kalman_significance(spec, spec_std,
                                                            sig_ts=sig_ts,
                                                            coeffs=coeffs)
                 snrk = (2*significance_kalman)**0.5
@@ -4,9 +4,8 @@ from future.utils import itervalues, viewitems, iteritems, listvalues, listitems
 
 import os.path
 import numpy as np
-from astropy import time
-import pwkit.environments.casa.util as casautil
-from rfpipe import fileLock
+from concurrent import futures
+from rfpipe import fileLock, lazy
 import pickle
 
 import logging
@@ -17,7 +16,8 @@ try:
 except ImportError:
     pass
 
-qa = casautil.tools.quanta()
+qa = lazy.casatool('quanta')
+time = lazy.lazy_import('astropy.time')
 
 
 def data_prep(st, segment, data, flagversion="latest", returnsoltime=False):
@@ -47,7 +47,8 @@ def data_prep(st, segment, data, flagversion="latest", returnsoltime=False):
     if st.gainfile is not None:
         logger.info("Applying calibration with {0}".format(st.gainfile))
         ret = calibration.apply_telcal(st, datap, savesols=st.prefs.savesols,
-                                       returnsoltime=returnsoltime)
+                                       returnsoltime=returnsoltime,
+                                       inplace=True)
         if returnsoltime:
             datap, soltime = ret
         else:
@@ -62,7 +63,12 @@ def data_prep(st, segment, data, flagversion="latest", returnsoltime=False):
     # support backwards compatibility for reproducible flagging
     logger.info("Flagging with version: {0}".format(flagversion))
     if flagversion == "latest":
-        datap = flagging.flag_data(st, datap)
+        if st.prefs.savenoise:
+            datap, flagsummary = flagging.flag_data(st, datap,
+                                                    returnsummary=True)
+            save_flags(st, segment, flagsummary)
+        else:
+            datap = flagging.flag_data(st, datap)
     elif flagversion == "rtpipe":
         datap = flagging.flag_data_rtpipe(st, datap)
 
@@ -71,9 +77,11 @@ def data_prep(st, segment, data, flagversion="latest", returnsoltime=False):
         logger.warning('Flagged {0:.1f}% of data. Zeroing all if greater than 80%.'.format(zerofrac*100))
         return np.array([])
 
-    if st.prefs.timesub == 'mean':
-        logger.info('Subtracting mean visibility in time.')
-        datap = util.meantsub(datap, parallel=st.prefs.nthread > 1)
+    if st.prefs.timesub in ['mean', 'median', 'sigmaclip']:
+        logger.info('Subtracting {0} visibility in time.'
+                    .format(st.prefs.timesub))
+        datap = util.meantsub(datap, parallel=st.prefs.nthread > 1,
+                              mode=st.prefs.timesub, nthread=st.prefs.nthread)
     else:
         logger.info('No visibility subtraction done.')
 
@@ -125,6 +133,8 @@ def read_segment(st, segment, cfile=None, timeout=10):
     elif st.metadata.datasource == 'vyssim':
         data_read = read_vys_segment(st, segment, cfile=cfile, timeout=timeout,
                                      returnsim=True)
+    elif st.metadata.datasource == 'replay':
+        data_read = read_replay_segment(st, segment, timeout=timeout)
     else:
         logger.error('Datasource {0} not recognized.'
                      .format(st.metadata.datasource))
@@ -160,7 +170,9 @@ def prep_standard(st, segment, data):
     # read and apply flags for given ant/time range. 0=bad, 1=good
     if st.prefs.applyonlineflags and st.metadata.datasource in ['vys', 'sdm']:
         flags = flagging.getonlineflags(st, segment)
-        data = np.where(flags[None, :, None, None], data, 0j)
+        if not flags.all():
+            data = np.require(data, requirements='W')
+            data[:, np.where(flags == 0)[0]] = 0j
     else:
         logger.info('Not applying online flags.')
 
@@ -198,6 +210,7 @@ def prep_standard(st, segment, data):
 
         assert isinstance(st.prefs.simulated_transient, list), "Simulated transient must be list of tuples."
 
+        transients = []
         for params in st.prefs.simulated_transient:
             assert len(params) == 7 or len(params) == 8, ("Transient requires 7 or 8 parameters: "
                                                           "(segment, i0/int, dm/pc/cm3, dt/s, "
@@ -218,19 +231,18 @@ def prep_standard(st, segment, data):
                                 "l,m={6},{7}"
                                 .format(mock_segment, i0, dm, dt, amp,
                                         amp+ampslope, l, m))
-                try:
-                    model = np.require(np.broadcast_to(util.make_transient_data(st, amp, i0, dm, dt, ampslope=ampslope)
-                                                       .transpose()[:, None, :, None],
-                                                       st.datashape),
-                                       requirements='W')
-                except IndexError:
-                    logger.warning("IndexError while adding transient. Skipping...")
-                    continue
-
-                if st.gainfile is not None:
-                    model = calibration.apply_telcal(st, model, sign=-1)
-                util.phase_shift(model, uvw, -l, -m)
-                data += model
+                transients.append((i0, dm, dt, amp, l, m, ampslope))
+
+        if len(transients):
+            # back out calibration from a unit integration to get gains
+            if st.gainfile is not None:
+                gain = calibration.apply_telcal(st, np.ones((1,)+st.datashape[1:],
+                                                            dtype='complex64'),
+                                                sign=-1, inplace=True)[0]
+            else:
+                gain = None
+            data = np.require(data, requirements='W')
+            util.add_transients(st, data, transients, uvw, gain=gain)
 
     if st.otfcorrections is not None:
         # shift phasecenters to first phasecenter in segment
@@ -298,6 +310,30 @@ def read_vys_segment(st, seg, cfile=None, timeout=10, offset=4, returnsim=False)
             return np.array([])
 
 
+def read_replay_segment(st, seg, timeout=10, offset=4):
+    """ Read segment seg from replay of scan at real integration cadence.
+    Uses sdm data if bdf defined, otherwise simulates data.
+    timeout is a multiple of read time in seconds to wait.
+    offset is extra time in seconds to keep reader open.
+    """
+
+    from rfpipe import replay
+
+    logger.info('Replaying segment {0}: {1} s ints with shape {2}'
+                .format(seg, st.metadata.inttime, st.datashape_orig))
+
+    with replay.Reader(st, seg, timeout=timeout, offset=offset) as reader:
+        if reader is not None:
+            data = reader.readwindow()
+        else:
+            data = None
+
+    if data is not None:
+        return data
+    else:
+        return np.array([])
+
+
 def read_bdf_segment(st, segment):
     """ Uses sdmpy to reads bdf (sdm) format data into numpy array in given
     segment. Each segment has st.readints integrations.
@@ -392,6 +428,35 @@ def save_noise(st, segment, data, chunk=500):
                     .format(len(results), 's'[:len(results)-1], segment, noisefile))
 
 
+def save_flags(st, segment, summary):
+    """ Appends flagging summary (structured array from flagging.flag_data)
+    for segment to flag file of scan (next to noise file).
+    Each segment is one npy record with segment number as first field.
+    """
+
+    rows = np.zeros(len(summary), dtype=[(str('segment'), np.int32)] +
+                    summary.dtype.descr)
+    rows['segment'] = segment
+    for name in summary.dtype.names:
+        rows[name] = summary[name]
+
+    try:
+        flagfile = st.flagfile
+        with fileLock.FileLock(flagfile+'.lock', timeout=60):
+            with open(flagfile, 'ab+') as fp:
+                np.save(fp, rows)
+    except fileLock.FileLock.FileLockException:
+        flagfile = ('{0}_seg{1}.npy'
+                    .format(os.path.splitext(st.flagfile)[0], segment))
+        logger.warning('Flag file writing timeout. '
+                       'Spilling to new file {0}.'.format(flagfile))
+        with open(flagfile, 'ab+') as fp:
+            np.save(fp, rows)
+
+    logger.info('Wrote flagging summary from segment {0} to {1}'
+                .format(segment, flagfile))
+
+
 def estimate_noiseperbl(data):
     """ Takes large data array and sigma clips it to find noise per bl for
     input to detect_bispectra.
@@ -405,9 +470,15 @@ def estimate_noiseperbl(data):
     return noiseperbl
 
 
-def simulate_segment(st, loc=0., scale=1., segment=None):
+def simulate_segment(st, loc=0., scale=1., segment=None, seed=None):
     """ Simulates visibilities for a segment.
     If segment (int) given, then read will behave like vysmaw client and skip if too late.
+    Noise is drawn from independent np.random.Generator stream per
+    integration spawned from seed, so data depend only on seed (not nthread).
+    numpy<1.17 uses a RandomState per integration instead.
+    Default seed is drawn from global RNG (reproducible with np.random.seed).
+    Optionally adds correlated RFI (prefs.simulated_rfi) and applies
+    antenna gain structure (prefs.simulated_gain).
     """
 
     # mimic real-time environment by skipping simulation when late
@@ -422,16 +493,117 @@ def simulate_segment(st, loc=0., scale=1., segment=None):
 
     logger.info('Simulating data with shape {0}'.format(st.datashape_orig))
 
+    if seed is None:
+        seed = np.random.randint(2**31)
+    if hasattr(np.random, 'SeedSequence'):
+        seedseqs = np.random.SeedSequence(seed).spawn(st.readints+1)
+    else:  # numpy<1.17
+        seedseqs = np.random.RandomState(seed).randint(2**31,
+                                                       size=st.readints+1)
+
     data = np.empty(st.datashape_orig, dtype='complex64', order='C')
-    for i in range(len(data)):
-        data[i].real = np.random.normal(loc=loc, scale=scale,
-                                        size=st.datashape_orig[1:]).astype(np.float32)
-        data[i].imag = np.random.normal(loc=loc, scale=scale,
-                                        size=st.datashape_orig[1:]).astype(np.float32)
+    nthread = min(st.prefs.nthread, st.readints)
+    if nthread > 1:
+        with futures.ThreadPoolExecutor(max_workers=nthread) as ex:
+            list(ex.map(lambda i: _fill_normal(data[i], seedseqs[i], loc,
+                                               scale),
+                        range(st.readints)))
+    else:
+        for i in range(st.readints):
+            _fill_normal(data[i], seedseqs[i], loc, scale)
+
+    rng = _make_rng(seedseqs[-1])
+    if st.prefs.simulated_rfi is not None:
+        nchan, nint, amp = st.prefs.simulated_rfi
+        add_rfi(st, data, nchan, nint, amp*scale, rng)
+
+    if st.prefs.simulated_gain:
+        data *= make_blgain(st, rng)
 
     return data
 
 
+def _make_rng(seedseq):
+    """ Generator for seedseq or RandomState for int seed (numpy<1.17) """
+
+    if hasattr(np.random, 'default_rng'):
+        return np.random.default_rng(seedseq)
+    else:
+        return np.random.RandomState(seedseq)
+
+
+def _fill_normal(arr, seedseq, loc, scale):
+    """ Fill complex64 array in place with real and imaginary parts drawn
+    from normal distribution. Generator releases GIL while filling.
+    """
+
+    arrf = arr.view(np.float32)
+    rng = _make_rng(seedseq)
+    if isinstance(rng, np.random.RandomState):
+        arrf[...] = rng.standard_normal(arrf.shape)
+    else:
+        rng.standard_normal(dtype=np.float32, out=arrf)
+    if scale != 1.:
+        arrf *= scale
+    if loc != 0.:
+        arrf += loc
+
+
+def add_rfi(st, data, nchan, nint, amp, rng):
+    """ Add RFI to data (orig shape) in place.
+    nchan channels get persistent narrowband signal and nint integrations get
+    broadband signal. Each has random complex amplitude in time (scaled by
+    amp) and fixed random phase per baseline, so it is correlated across
+    baselines and polarizations.
+    """
+
+    readints, nbl, nchan_orig, npol = data.shape
+
+    chans = np.sort(rng.choice(nchan_orig, size=min(nchan, nchan_orig),
+                               replace=False))
+    if len(chans):
+        signal = amp*(rng.standard_normal((readints, len(chans))) +
+                      1j*rng.standard_normal((readints, len(chans))))/np.sqrt(2)
+        phase = np.exp(2j*np.pi*rng.uniform(size=(nbl, len(chans))))
+        data[:, :, chans] += (signal[:, None, :, None] *
+                              phase[None, :, :, None]).astype(np.complex64)
+
+    ints = np.sort(rng.choice(readints, size=min(nint, readints),
+                              replace=False))
+    if len(ints):
+        signal = amp*(rng.standard_normal(len(ints)) +
+                      1j*rng.standard_normal(len(ints)))/np.sqrt(2)
+        phase = np.exp(2j*np.pi*rng.uniform(size=(nbl, nchan_orig)))
+        data[ints] += (signal[:, None, None, None] *
+                       phase[None, :, :, None]).astype(np.complex64)
+
+    logger.info("Added RFI in {0} channels and {1} integrations with amp {2}"
+                .format(len(chans), len(ints), amp))
+
+
+def make_blgain(st, rng, ripple=0.1, maxdelay=5.):
+    """ Random antenna gains with bandpass ripple (fractional amplitude) and
+    delay (up to maxdelay in ns) per antenna and polarization.
+    Returns baseline gain G[a1]*conj(G[a2]) with shape of data[0] (orig).
+    """
+
+    nants = st.metadata.nants_orig
+    freq = st.metadata.freq_orig
+    npol = st.metadata.npol_orig
+    relfreq = freq - freq[0]
+
+    amp = 1 + ripple*np.sin(2*np.pi*(relfreq[None, :, None] /
+                                     rng.uniform(0.05, 0.5, (nants, 1, npol)) +
+                                     rng.uniform(size=(nants, 1, npol))))
+    phase = 2*np.pi*(rng.uniform(size=(nants, 1, npol)) +
+                     rng.uniform(-maxdelay, maxdelay, (nants, 1, npol)) *
+                     relfreq[None, :, None])
+    gain = amp*np.exp(1j*phase)
+
+    ant2, ant1 = np.tril_indices(nants, -1)
+    return (gain[ant1]*gain[ant2].conj()).astype(np.complex64)
+
+
 def sdm_sources(sdmname):
     """ Use sdmpy to get all sources and ra,dec per scan as dict """
 
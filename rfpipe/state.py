@@ -4,15 +4,106 @@ from future.utils import itervalues, viewitems, iteritems, listvalues, listitems
 from io import open
 
 import os
+import copy
+import functools
+import attr
 import numpy as np
-from astropy import time
-from rfpipe import version
-import pwkit.environments.casa.util as casautil
+from rfpipe import version, lazy
 
 import logging
 logger = logging.getLogger(__name__)
 
-qa = casautil.tools.quanta()
+qa = lazy.casatool('quanta')
+time = lazy.lazy_import('astropy.time')
+
+
+def memoized(func):
+    """ Property of State that is cached until prefs or metadata change.
+    Values of None are not cached, so they are looked for on next access.
+    Lists are returned as copies, so changing them does not change the cache.
+    Arrays should be made read-only. Cache is also emptied by State.clearcache.
+    """
+
+    name = func.__name__
+
+    @functools.wraps(func)
+    def getter(self):
+        memo = _getmemo(self)
+        try:
+            return _copylist(memo[name])
+        except KeyError:
+            value = func(self)
+            if value is not None:
+                memo[name] = _copylist(value)
+            return value
+
+    return property(getter)
+
+
+def _copylist(value):
+    """ Copy of (nested) list. Other values are returned as is. """
+
+    if isinstance(value, list):
+        return [_copylist(vv) for vv in value]
+    else:
+        return value
+
+
+def _getmemo(st):
+    """ Memo dict of State, emptied if prefs or metadata have changed """
+
+    prefs = st.prefs
+    metadata = st.metadata
+    key = (getattr(prefs, '_nchange', 0),
+           getattr(metadata, '_nchange', 0))
+    memokey = st.__dict__.get('_memokey')
+    if (memokey is None or memokey[0] is not prefs or
+       memokey[1] is not metadata or memokey[2] != key):
+        st._memo = {}
+        st._memokey = (prefs, metadata, key)
+
+    return st._memo
+
+
+@attr.s(frozen=True, eq=False)
+class Snapshot(object):
+    """ Compact record of resolved state quantities with prefs and metadata.
+    Cheap to pickle and ship to workers. State.from_snapshot rebuilds a State
+    without reading metadata or recalculating dmarr, segmenttimes or uv grid.
+    Attributes cannot be reset, arrays are read-only and prefs/metadata are
+    private copies, so later changes to the State do not change the snapshot.
+    dtarr and uvres are recorded for reference. npixx/npixy follow from prefs
+    and the stored values. blarr is stored as int16. Holders that keep their
+    own prefs and metadata (e.g., CandCollection) keep only the derived values
+    (see derived).
+    """
+
+    prefs = attr.ib()
+    metadata = attr.ib()
+    segmenttimes = attr.ib()
+    dmarr = attr.ib()
+    freq = attr.ib()
+    chans = attr.ib()
+    blarr = attr.ib()
+    npixx_full = attr.ib()
+    npixy_full = attr.ib()
+    dtarr = attr.ib()
+    uvres = attr.ib()
+    rtpipe_version = attr.ib(default=None)
+
+    def derived(self):
+        """ Snapshot without prefs and metadata """
+
+        if self.prefs is None and self.metadata is None:
+            return self
+        else:
+            return attr.evolve(self, prefs=None, metadata=None)
+
+
+def _readonly(arr):
+    arr = np.array(arr)
+    arr.flags.writeable = False
+    return arr
 
 
 class State(object):
@@ -65,7 +156,7 @@ class State(object):
             except TypeError as exc:
                 from fuzzywuzzy import fuzz
                 badarg = exc.args[0].split('\'')[1]
-                closeprefs = [pref for pref in list(preferences.Preferences().__dict__) if fuzz.ratio(badarg, pref) > 50]
+                closeprefs = [pref.name for pref in attr.fields(preferences.Preferences) if fuzz.ratio(badarg, pref.name) > 50]
                 raise TypeError("Preference {0} not recognized. Did you mean {1}?".format(badarg, ', '.join(closeprefs)))
 
         # TODO: not working
@@ -240,10 +331,67 @@ class State(object):
                             'GB/segment when using cuda imaging.'
                             .format(self.vismem))
 
+    def snapshot(self):
+        """ Compact, immutable record of resolved state (see Snapshot).
+        Made once and shared until prefs or metadata change.
+        """
+
+        memo = _getmemo(self)
+        if 'snapshot' not in memo:
+            snap = Snapshot(prefs=copy.deepcopy(self.prefs),
+                            metadata=copy.deepcopy(self.metadata),
+                            segmenttimes=_readonly(self.segmenttimes),
+                            dmarr=tuple(self.dmarr),
+                            freq=_readonly(self.freq),
+                            chans=tuple(self.chans),
+                            blarr=_readonly(self.blarr.astype(np.int16)),
+                            npixx_full=self.npixx_full,
+                            npixy_full=self.npixy_full,
+                            dtarr=tuple(self.dtarr), uvres=self.uvres,
+                            rtpipe_version=getattr(self, 'rtpipe_version',
+                                                   None))
+            memo = _getmemo(self)
+            memo['snapshot'] = snap
+
+        return memo['snapshot']
+
+    @classmethod
+    def from_snapshot(cls, snapshot, lock=None, prefs=None, metadata=None):
+        """ Create State from Snapshot with cached values set from it.
+        prefs and metadata are used as given, if provided. Otherwise, State
+        gets its own copies of those in snapshot.
+        """
+
+        if prefs is None:
+            prefs = copy.deepcopy(snapshot.prefs)
+        if metadata is None:
+            metadata = copy.deepcopy(snapshot.metadata)
+        if prefs is None or metadata is None:
+            raise ValueError('Snapshot has no prefs/metadata. Provide them '
+                             'to from_snapshot.')
+
+        st = cls(inmeta=metadata, inprefs=prefs, lock=lock,
+                 showsummary=False, validate=False)
+        st._segmenttimes = np.array(snapshot.segmenttimes)
+        st._dmarr = list(snapshot.dmarr)
+        st._blarr = np.array(snapshot.blarr, dtype=int)
+        st._npixx_full = snapshot.npixx_full
+        st._npixy_full = snapshot.npixy_full
+        st._memo = {'freq': snapshot.freq, 'chans': list(snapshot.chans)}
+        st._memokey = (st.prefs, st.metadata,
+                       (getattr(st.prefs, '_nchange', 0),
+                        getattr(st.metadata, '_nchange', 0)))
+        if snapshot.rtpipe_version is not None:
+            st.rtpipe_version = snapshot.rtpipe_version
+
+        return st
+
     def clearcache(self):
-        cached = ['_dmarr', '_dmshifts', '_npol', '_blarr',
-                  '_segmenttimes', '_npixx_full', '_npixy_full',
-                  '_corrections']
+        """ Remove cached and memoized properties """
+
+        cached = ['_dmarr', '_dmshifts', '_delaytable', '_npol', '_blarr',
+                  '_segmenttimes', '_nworkers', '_npixx_full', '_npixy_full',
+                  '_corrections', '_onlineflagtable', '_memo', '_memokey']
         for obj in cached:
             try:
                 delattr(self, obj)
@@ -302,7 +450,7 @@ class State(object):
         else:
             return [1]
 
-    @property
+    @memoized
     def freq(self):
         """ Frequencies for each channel in increasing order.
         TODO: test effect of metadata spw out of order (but not data reading order?)
@@ -310,9 +458,11 @@ class State(object):
 
         # TODO: add support for frequency downsampling
 
-        return self.metadata.freq_orig[self.chans]
+        freq = self.metadata.freq_orig[self.chans]
+        freq.flags.writeable = False
+        return freq
 
-    @property
+    @memoized
     def chans(self):
         """ List of channel indices to use. Drawn from preferences,
         with backup to take all those for preferred spw.
@@ -358,10 +508,21 @@ class State(object):
 
         return self.metadata.inttime
 
-    @property
+    @memoized
     def nchan(self):
         return len(self.chans)
 
+    @property
+    def onlineflagtable(self):
+        """ Online flag intervals and baselines flagged in each for scan.
+        Only defined for sdm data. Gets cached.
+        """
+
+        if not hasattr(self, '_onlineflagtable'):
+            from rfpipe import flagging
+            self._onlineflagtable = flagging.make_onlineflagtable(self)
+        return self._onlineflagtable
+
     @property
     def dmshifts(self):
         """ Calculate max DM delay in units of integrations for each dm trial.
@@ -369,12 +530,36 @@ class State(object):
         """
 
         if not hasattr(self, '_dmshifts'):
-            from rfpipe import util
-            self._dmshifts = [util.calc_delay(self.freq, self.freq.max(), dm,
-                              self.inttime).max()
-                              for dm in self.dmarr]
+            self._dmshifts = self.delaytable.max(axis=1).tolist()
         return self._dmshifts
 
+    @property
+    def delaytable(self):
+        """ Dispersion delay in units of integrations for each dm trial and
+        channel with shape (ndm, nchan). Gets cached.
+        Uses default scale (see dmscale for reproducing old candidates).
+        """
+
+        if not hasattr(self, '_delaytable'):
+            from rfpipe import util
+            self._delaytable = util.calc_delaytable(self.freq,
+                                                    self.freq.max(),
+                                                    self.dmarr, self.inttime)
+            self._delaytable.flags.writeable = False
+        return self._delaytable
+
+    @property
+    def dmscale(self):
+        """ Linear prefactor of dispersion delay to reproduce candidates.
+        None uses default, but reproducing rtpipe<=1.54 candidates requires
+        4.2e-3. Not used for delaytable, dmshifts or t_overlap.
+        """
+
+        if hasattr(self, 'rtpipe_version') and self.rtpipe_version <= 1.54:
+            return 4.2e-3
+        else:
+            return None
+
     @property
     def t_overlap(self):
         """ Max DM delay in seconds that is fixed to int mult of integration time.
@@ -382,17 +567,21 @@ class State(object):
 
         return max(self.dmshifts)*self.inttime
 
-    @property
+    @memoized
     def spw_chan_select(self):
         """ List of lists with selected channels per spw.
         Channel numbers assume selected data.
         """
 
         reffreq, nchan, chansize = self.metadata.spw_sorted_properties
+        chanindex = {}
+        for i, ch in enumerate(self.chans):
+            chanindex.setdefault(ch, i)
+
         chanlist = []
         for spwi in range(len(reffreq)):
             nch = nchan[spwi]
-            chans = [self.chans.index(ch) for ch in list(range(nch*spwi, nch*(spwi+1))) if ch in self.chans]
+            chans = [chanindex[ch] for ch in range(nch*spwi, nch*(spwi+1)) if ch in chanindex]
             chanlist.append(chans)
 
         return chanlist
@@ -413,7 +602,7 @@ class State(object):
 
         return self._npol
 
-    @property
+    @memoized
     def pols(self):
         """
         Polarizations to use based on preference in prefs.selectpol
@@ -442,7 +631,9 @@ class State(object):
         """ Finds optimal uv/image pixel extent in powers of 2 and 3"""
 
         if not hasattr(self, '_npixx_full'):
-            urange_orig, vrange_orig = self.metadata.uvrange_orig
+            from rfpipe import util
+            urange_orig, vrange_orig = util.calc_uvrange(self.metadata,
+                                                         backend=self.prefs.uvwbackend)
             urange = urange_orig * (self.freq.max()
                                     / self.metadata.freq_orig.min())
             powers = np.fromfunction(lambda i, j: 2**i*3**j, (14, 10),
@@ -460,7 +651,9 @@ class State(object):
         """ Finds optimal uv/image pixel extent in powers of 2 and 3"""
 
         if not hasattr(self, '_npixy_full'):
-            urange_orig, vrange_orig = self.metadata.uvrange_orig
+            from rfpipe import util
+            urange_orig, vrange_orig = util.calc_uvrange(self.metadata,
+                                                         backend=self.prefs.uvwbackend)
             vrange = vrange_orig * (self.freq.max()
                                     / self.metadata.freq_orig.min())
             powers = np.fromfunction(lambda i, j: 2**i*3**j, (14, 10),
@@ -553,24 +746,25 @@ class State(object):
 
         return self.prefs.fftmode
 
-    @property
+    @memoized
     def ants(self):
         return sorted([ant for ant in self.metadata.antids
                        if ant not in self.prefs.excludeants])
 
-    @property
+    @memoized
     def nants(self):
         return len(self.ants)
 
-    @property
+    @memoized
     def nbl(self):
         return int(self.nants*(self.nants-1)/2)
 
-    @property
+    @memoized
     def gainfile(self):
         """ Calibration file (telcal) from preferences or found from ".GN"
         suffix with datasetId. Default behavior is to find file in workdir.
-        Value of None means none will be applied.
+        Value of None means none will be applied (and file is looked for
+        again on next access).
         """
 
         if self.prefs.gainfile is None:
@@ -598,15 +792,19 @@ class State(object):
 
         return self._blarr
 
-    @property
+    @memoized
     def blarr_names(self):
-        return np.array([[self.ants[i], self.ants[j]]
-                         for j in range(self.nants) for i in range(0, j)])
+        blarr_names = np.array([[self.ants[i], self.ants[j]]
+                                for j in range(self.nants) for i in range(0, j)])
+        blarr_names.flags.writeable = False
+        return blarr_names
 
-    @property
+    @memoized
     def blarr_arms(self):
-        return np.array([[self.metadata.stationids[i][0], self.metadata.stationids[j][0]]
-                         for j in range(self.nants) for i in range(0, j)])
+        blarr_arms = np.array([[self.metadata.stationids[i][0], self.metadata.stationids[j][0]]
+                               for j in range(self.nants) for i in range(0, j)])
+        blarr_arms.flags.writeable = False
+        return blarr_arms
 
     def blind_arm(self, arm):
         """ Give the index of baseline with given arm "N", "E", or "W".
@@ -633,6 +831,11 @@ class State(object):
                 self._segmenttimes = np.array(self.prefs.segmenttimes)
 #            elif self.prefs.nsegment:
 #                self._segmenttimes = calc_segment_times(self, self.prefs.nsegment)
+            elif self.prefs.memoryplan:
+                from rfpipe import planner
+                segmenttimes, nworkers, summary = planner.plan_segments(self, nworkers=self.prefs.memoryplan)
+                self._segmenttimes = segmenttimes
+                self._nworkers = nworkers
             else:
                 from rfpipe import util
                 self._segmenttimes = util.calc_segment_times(self, 1.)
@@ -641,6 +844,22 @@ class State(object):
 
         return self._segmenttimes
 
+    @property
+    def nworkers(self):
+        """ Number of workers that can process segments concurrently within
+        memory_limit. Set by planner when prefs.memoryplan is used, else 1.
+        pipeline_scan searches segments with this many processes.
+        """
+
+        if not hasattr(self, '_nworkers'):
+            if self.prefs.memoryplan:
+                from rfpipe import planner
+                self._nworkers = planner.plan_segments(self, nworkers=self.prefs.memoryplan)[1]
+            else:
+                self._nworkers = 1
+
+        return self._nworkers
+
     @property
     def otfcorrections(self):
         """ Use otf phasecenters (if set) to calc the phase shift from 
@@ -861,6 +1080,12 @@ class State(object):
 
         return self.candsfile.replace('cands_', 'noise_')
 
+    @property
+    def flagfile(self):
+        """ File name to write flagging summaries into """
+
+        return os.path.splitext(self.candsfile.replace('cands_', 'flags_'))[0] + '.npy'
+
     @property
     def mockfile(self):
         """ File name to write mocks into """
@@ -0,0 +1,176 @@
+from __future__ import print_function, division, absolute_import, unicode_literals
+from builtins import bytes, dict, object, range, map, input, str
+from future.utils import itervalues, viewitems, iteritems, listvalues, listitems
+from io import open
+
+import rfpipe, rfpipe.calibration
+import pytest
+import os.path
+import shutil
+import numpy as np
+
+_install_dir = os.path.abspath(os.path.dirname(__file__))
+gainfile = os.path.join(_install_dir,
+                        'data/16A-459_TEST_1hr_000.57633.66130137732.GN')
+
+
+def parseGN_ref(telcalfile):
+    """ Line by line parsing of telcal file """
+
+    sols = []
+    with open(telcalfile, 'r') as fp:
+        for line in fp.readlines()[3:]:
+            fields = line.split()
+            sols.append((float(fields[0]), fields[4], float(fields[5]),
+                         int(fields[6].lstrip('ea')),
+                         ('C' in fields[4] or 'D' in fields[4]), fields[16],
+                         float(fields[7]), float(fields[8]),
+                         float(fields[10]), fields[11] == 'true'))
+    return sols
+
+
+@pytest.fixture
+def gncopy(tmpdir):
+    fn = str(tmpdir.join('test.GN'))
+    shutil.copy(gainfile, fn)
+    return fn
+
+
+def test_parseGN(gncopy):
+    sols = rfpipe.calibration.parseGN(gncopy)
+    ref = parseGN_ref(gncopy)
+    assert len(sols) == len(ref)
+    assert all([tuple(sol) == row for (sol, row) in zip(sols.tolist(), ref)])
+
+
+def test_parseGN_cache(gncopy):
+    sols = rfpipe.calibration.parseGN(gncopy)
+    assert rfpipe.calibration.parseGN(gncopy) is sols
+
+    # bad line is skipped and modified file is parsed again
+    with open(gncopy, 'a') as fp:
+        fp.write('57633.7  15:57:16.100  0.3  07:35:43.802  A-0  2553.00  '
+                 'eaXX  0.2  11.3  0.02  -0.01  false  false  0.4  -1.1  '
+                 '1.2  J0555+3948\n')
+    sols2 = rfpipe.calibration.parseGN(gncopy)
+    assert sols2 is not sols
+    assert len(sols2) == len(sols)
+
+
+def test_parseGN_append(gncopy):
+    with open(gainfile, 'r') as fp:
+        lines = fp.readlines()
+
+    # file is written with partial last line, then completed and extended
+    with open(gncopy, 'w') as fp:
+        fp.writelines(lines[:500])
+        fp.write(lines[500][:40])
+    sols = rfpipe.calibration.parseGN(gncopy)
+    assert len(sols) == 497
+
+    with open(gncopy, 'a') as fp:
+        fp.write(lines[500][40:])
+        fp.writelines(lines[501:])
+    sols = rfpipe.calibration.parseGN(gncopy)
+    assert rfpipe.calibration._gncache[os.path.abspath(gncopy)]['offset'] == os.path.getsize(gncopy)
+    assert all([tuple(sol) == row for (sol, row) in zip(sols.tolist(), parseGN_ref(gainfile))])
+    assert len(sols) == len(parseGN_ref(gainfile))
+
+
+def test_parseGN_halfline(gncopy):
+    with open(gainfile, 'r') as fp:
+        lines = fp.readlines()
+
+    # line cut inside source name would parse, but is not yet complete
+    with open(gncopy, 'w') as fp:
+        fp.writelines(lines[:500])
+        fp.write(lines[500].rstrip()[:-3])
+    sols = rfpipe.calibration.parseGN(gncopy)
+    assert len(sols) == 497
+    assert len(rfpipe.calibration.parseGN(gncopy)) == 497
+
+    with open(gncopy, 'a') as fp:
+        fp.write(lines[500].rstrip()[-3:] + '\n')
+    sols = rfpipe.calibration.parseGN(gncopy)
+    assert len(sols) == 498
+    assert tuple(sols.tolist()[-1]) == parseGN_ref(gainfile)[497]
+
+
+def test_parseGN_nonewline(gncopy):
+    with open(gainfile, 'r') as fp:
+        text = fp.read()
+
+    # finished file without trailing newline keeps its last solution
+    with open(gncopy, 'w') as fp:
+        fp.write(text.rstrip('\n'))
+    sols = rfpipe.calibration.parseGN(gncopy)
+    assert len(sols) == len(parseGN_ref(gainfile)) - 1
+
+    mtime = os.path.getmtime(gncopy) - 2*rfpipe.calibration.gnsettle
+    os.utime(gncopy, (mtime, mtime))
+    sols = rfpipe.calibration.parseGN(gncopy)
+    assert len(sols) == len(parseGN_ref(gainfile))
+    assert rfpipe.calibration.parseGN(gncopy) is sols
+
+def calcgaindelay_ref(sols, bls, freqarr, pols, chansize, nch, sign=1):
+    """ Loop over baselines, spw, pol and solutions """
+
+    gaindelay = np.zeros((len(bls), len(freqarr)*nch, len(pols)),
+                         dtype=np.complex64)
+    relfreq = chansize*(np.arange(nch) - nch//2)*1e6
+    for bi, (ant1, ant2) in enumerate(bls):
+        for fi in range(len(freqarr)):
+            for pi in range(len(pols)):
+                g1 = g2 = d1 = d2 = 0.
+                for sol in sols:
+                    if ((sol['polarization'] == pols[pi]) and
+                       (np.abs(sol['skyfreq']-freqarr[fi]) < chansize) and
+                       (not sol['flagged'])):
+                        if sol['antnum'] == ant1:
+                            g1 = sol['amp']*np.exp(1j*np.radians(sol['phase']))
+                            d1 = sol['delay']
+                        if sol['antnum'] == ant2:
+                            g2 = sol['amp']*np.exp(-1j*np.radians(sol['phase']))
+                            d2 = sol['delay']
+                if (g1 != 0.) and (g2 != 0.):
+                    g1g2 = 1./(g1*g2) if sign == 1 else g1*g2
+                else:
+                    g1g2 = 0.
+                d1d2 = sign*2*np.pi*((d1-d2) * 1e-9) * relfreq
+                gaindelay[bi, fi*nch:(fi+1)*nch, pi] = g1g2*np.exp(-1j*d1d2)
+
+    return gaindelay
+
+
+@pytest.mark.parametrize('sign', [1, -1])
+def test_calcgaindelay(sign):
+    sols = rfpipe.calibration.parseGN(gainfile)
+    sols = rfpipe.calibration.select(sols, time=sols['mjd'].max())
+    sols = sols[2:].copy()  # incomplete solution for one ant
+    sols['flagged'][10] = True
+    sols['amp'][20] = 0.
+
+    freqs = np.unique(sols['skyfreq'])[:4]
+    bls = np.array([(a1, a2) for a1 in range(1, 29) for a2 in range(a1+1, 29)])
+    gd = rfpipe.calibration.calcgaindelay(sols, bls, freqs, [0, 1], 2., 8,
+                                          sign=sign)
+    gdref = calcgaindelay_ref(sols, bls, freqs, [0, 1], 2., 8, sign=sign)
+    assert gd.shape == gdref.shape
+    assert np.allclose(gd, gdref, rtol=1e-5)
+    assert (gd == 0).any()
+
+
+def test_getgaindelay():
+    t0 = 57633.67
+    meta = rfpipe.metadata.mock_metadata(t0, t0+0.1/(24*3600), 10, 4, 32*4,
+                                         2, 5e3, datasource='sim')
+    st = rfpipe.state.State(inmeta=meta)
+    sols = rfpipe.calibration.parseGN(gainfile)
+    sols = rfpipe.calibration.select(sols, time=t0)
+    skyfreqs = np.unique(sols['skyfreq'])[:4]
+
+    gd = rfpipe.calibration.getgaindelay(st, sols, skyfreqs, sign=1)
+    assert gd.shape == (st.nbl, st.nchan, 2)
+    assert rfpipe.calibration.getgaindelay(st, sols, skyfreqs, sign=1) is gd
+    assert rfpipe.calibration.getgaindelay(st, sols, skyfreqs, sign=-1) is not gd
+    assert rfpipe.calibration.getgaindelay(st, sols[1:], skyfreqs, sign=1) is not gd
@@ -0,0 +1,179 @@
+from __future__ import print_function, division, absolute_import, unicode_literals
+from builtins import bytes, dict, object, range, map, input, str
+from future.utils import itervalues, viewitems, iteritems, listvalues, listitems
+from io import open
+
+import rfpipe, rfpipe.flagging
+import pytest
+import numpy as np
+from astropy import time
+
+
+def slidedev_ref(arr, win):
+    """ Brute-force median over window (leaving out center sample) """
+
+    med = np.ma.zeros(arr.shape)
+    for i in range(len(arr)):
+        inds = list(range(max(0, i-win//2), i)) + list(range(i+1, min(i+win//2, len(arr))))
+        med[i] = np.ma.median(arr.take(inds, axis=0), axis=0)
+
+    return arr-med
+
+
+def blstd_select_ref(blstd, sigma, convergence):
+    """ Iteration with full median/std recalculated on each pass.
+    Cells masked on input are never selected.
+    """
+
+    mask0 = np.ma.getmaskarray(blstd).copy()
+    blstdmednew = np.ma.median(blstd)
+    blstdstdnew = np.ma.std(blstd)
+    blstdstd = blstdstdnew*2
+    while (blstdstd-blstdstdnew)/blstdstd > convergence:
+        blstdstd = blstdstdnew
+        blstdmed = blstdmednew
+        blstd = np.ma.masked_where(blstd > blstdmed + sigma*blstdstd, blstd, copy=False)
+        blstdmednew = np.ma.median(blstd)
+        blstdstdnew = np.ma.std(blstd)
+
+    return np.where((np.ma.getdata(blstd) > blstdmednew + sigma*blstdstdnew) & ~mask0)
+
+
+@pytest.mark.parametrize('convergence', [0.5, 0.05, 0.008])
+def test_blstd_select(convergence):
+    blstd = np.ma.masked_array(np.random.chisquare(3, size=(100, 64, 2)))
+    blstd[10, 5:10] = 30.
+    blstd[20:22] = np.ma.masked
+
+    flags = rfpipe.flagging._blstd_select(blstd.copy(), 3., convergence)
+    ref = blstd_select_ref(blstd.copy(), 3., convergence)
+    assert (np.array(np.where(flags)) == np.array(ref)).all()
+    assert flags[10, 5:10].all()
+
+
+def test_blstd_select_masked():
+    blstd = np.ma.masked_array(np.random.chisquare(3, size=(50, 16, 2)))
+    blstd[3, 4, 0] = 100.
+    blstd[3, 4, 0] = np.ma.masked  # large value under mask
+
+    flags = rfpipe.flagging._blstd_select(blstd.copy(), 3., 0.05)
+    ref = blstd_select_ref(blstd.copy(), 3., 0.05)
+    assert not flags[3, 4, 0]
+    assert (np.array(np.where(flags)) == np.array(ref)).all()
+
+
+@pytest.mark.parametrize('win', [2, 3, 20])
+def test_slidedev(win):
+    lc = np.ma.masked_array(np.random.normal(size=(100, 2)).astype('float32'))
+    lc[10:15, 0] = np.ma.masked
+    lc[50] = 3.  # repeated values
+
+    dev = rfpipe.flagging.slidedev(lc, win)
+    devref = slidedev_ref(lc, win)
+    assert (np.ma.getmaskarray(dev) == np.ma.getmaskarray(devref)).all()
+    assert np.allclose(dev.compressed(), devref.compressed())
+
+
+@pytest.mark.parametrize('win', [3, 5, 12])
+def test_slidedev_ties(win):
+    # tied values and mixed signed zeros
+    rs = np.random.RandomState(1)
+    lcs = [np.array([1.7, 0.7, 0.9, -0.3, -0.0, -0.2, -1.2, -0.0, -0.0, 1.9,
+                     0.0, -3.1])]
+    lcs += [rs.choice([-1., -0., 0., 1., 2.], size=48) for i in range(20)]
+    for lc in lcs:
+        dev = rfpipe.flagging.slidedev(lc, win)
+        devref = np.zeros(len(lc))
+        for i in range(len(lc)):
+            window = np.concatenate((lc[max(0, i-win//2):i],
+                                     lc[i+1:i+win//2]))
+            devref[i] = lc[i] - np.median(window) if len(window) else np.nan
+        assert np.allclose(dev.filled(np.nan), devref, equal_nan=True)
+
+
+def test_slidedev_spectrum():
+    spec = np.ma.masked_array(np.random.normal(size=64))
+
+    dev = rfpipe.flagging.slidedev(spec, 10)
+    assert dev.shape == spec.shape
+    assert np.allclose(dev.compressed(), slidedev_ref(spec, 10).compressed())
+
+
+@pytest.fixture(scope="module")
+def mockdatam():
+    rs = np.random.RandomState(0)
+    data = (rs.normal(size=(40, 30, 64, 2)) +
+            1j*rs.normal(size=(40, 30, 64, 2))).astype('complex64')
+    data[5, :, :, 0] *= 10  # bad int in pol 0
+    data[:, :, 40, 1] *= 10  # bad chan in pol 1
+    data[:, 3, 10] = 0j
+    return np.ma.masked_values(data, 0j, copy=False, shrink=False)
+
+
+@pytest.mark.parametrize('stat', ['meanabs', 'std'])
+def test_shard_stat(mockdatam, stat):
+    chans = np.arange(16, 32)
+    for pol in range(2):
+        res = rfpipe.flagging._shard_stat(mockdatam, chans, pol, stat)
+        sub = mockdatam[:, :, 16:32, pol]
+        if stat == 'meanabs':
+            ref = np.abs(sub).mean(axis=1)
+        else:
+            ref = np.ma.std(sub, axis=1)
+        assert np.allclose(res, ref, rtol=1e-5)
+
+
+def test_flag_parallel(mockdatam):
+    from concurrent import futures
+
+    spwchans = [list(range(16*i, 16*(i+1))) for i in range(4)]
+    flaglist = [('badchtslide', 4., 10), ('blstd', 3., 0.05)]
+
+    datap = mockdatam.copy()
+    with futures.ThreadPoolExecutor(max_workers=4) as ex:
+        for mode, arg0, arg1 in flaglist:
+            if mode == 'blstd':
+                rfpipe.flagging.flag_blstd_parallel(datap, spwchans, arg0,
+                                                    arg1, ex)
+            else:
+                rfpipe.flagging.flag_badchtslide_parallel(datap, spwchans,
+                                                          arg0, arg1, ex)
+
+    # reference from serial flagging of each spw/pol
+    for chans in spwchans:
+        for pol in range(2):
+            datas = mockdatam[:, :, chans, pol:pol+1].copy()
+            for mode, arg0, arg1 in flaglist:
+                if mode == 'blstd':
+                    rfpipe.flagging.flag_blstd(datas, arg0, arg1)
+                else:
+                    rfpipe.flagging.flag_badchtslide(datas, [list(range(16))],
+                                                     arg0, arg1)
+            assert (datap.mask[:, :, chans, pol] == datas.mask[..., 0]).all()
+
+    assert datap.mask[5, :, :16, 0].all()
+    assert datap.mask[:, :, 40, 1].all()
+
+
+@pytest.mark.parametrize('flagparallel', [False, True])
+def test_flag_summary(flagparallel):
+    t0 = time.Time.now().mjd
+    meta = rfpipe.metadata.mock_metadata(t0, t0+0.1/(24*3600), 10, 4, 32*4,
+                                         2, 5e3, datasource='sim')
+    st = rfpipe.state.State(inmeta=meta,
+                            inprefs={'flagparallel': flagparallel,
+                                     'nthread': 2})
+    takepol = [st.metadata.pols_orig.index(pol) for pol in st.pols]
+    data = rfpipe.source.read_segment(st, 0).take(takepol, axis=3).take(st.chans, axis=2)
+    data[:, 0] = 0j
+
+    datap, summary = rfpipe.flagging.flag_data(st, data.copy(),
+                                               returnsummary=True)
+    assert len(summary) == len(st.prefs.flaglist) + 1
+    assert summary['mode'][0] == 'initial'
+    assert summary['bl'][0, 0] == data[:, 0].size
+    assert summary['nflagged'].sum() == (datap == 0j).sum()
+    assert (summary['spw'].sum(axis=1) == summary['nflagged']).all()
+    assert (summary['pol'].sum(axis=1) == summary['nflagged']).all()
+    assert (summary['bl'].sum(axis=1) == summary['nflagged']).all()
+    assert np.isclose(summary['fraction'][-1], (datap == 0j).mean())
@@ -0,0 +1,27 @@
+from __future__ import print_function, division, absolute_import, unicode_literals
+from builtins import bytes, dict, object, range, map, input, str
+from future.utils import itervalues, viewitems, iteritems, listvalues, listitems
+from io import open
+
+import numpy as np
+import rfpipe.lazy
+
+
+def test_lazy_import():
+    mod = rfpipe.lazy.lazy_import('json')
+    assert not mod.loaded
+    assert mod.loads('[1]') == [1]
+    assert mod.loaded
+
+
+def test_lazy_gufunc():
+    def add(x, y, res):
+        for i in range(len(x)):
+            res[i] = x[i] + y
+
+    gufunc = rfpipe.lazy.guvectorize([str("void(float64[:], float64, float64[:])")],
+                                     str("(n),()->(n)"), nopython=True)(add)
+    assert not gufunc.compiled
+    res = gufunc(np.arange(3.), 1.)
+    assert gufunc.compiled
+    assert np.allclose(res, np.arange(3.) + 1)
@@ -48,3 +48,52 @@ def test_state_phasecenter():
                             inprefs={'chans': range(10, 20)})
     assert st.otfcorrections is not None
     
+
+
+@pytest.mark.parametrize('nants', [3, 27])
+def test_blorder(nants):
+    ord1 = [i*nants+j for i in range(nants) for j in range(i+1, nants)]
+    ord2 = [i*nants+j for j in range(nants) for i in range(j)]
+    key = [ord1.index(new) for new in ord2]
+    assert (rfpipe.util.blorder(nants) == key).all()
+
+
+def test_uvw_model():
+    t0 = time.Time.now().mjd
+    meta = rfpipe.metadata.mock_metadata(t0, t0+1800/(24*3600), 27, 4, 32*4, 4,
+                                         1e6, datasource='sim', antconfig='A')
+    st = rfpipe.state.State(inmeta=meta, inprefs={'dmarr': [0]})
+
+    for mjd in np.linspace(t0, t0+1800/(24*3600), 5):
+        datetime = rfpipe.util.qa.time(rfpipe.util.qa.quantity(mjd, 'd'),
+                                       form='ymd', prec=8)[0]
+        uvw = rfpipe.util.calc_uvw(datetime, st.metadata.radec,
+                                   st.metadata.antpos, st.metadata.telescope)
+        assert np.allclose(rfpipe.util.get_uvw_mjd(st.metadata, mjd), uvw,
+                           atol=0.01)
+
+    assert st.npixx_full > 0
+    assert len(rfpipe.util._uvwcache)
+
+
+@pytest.mark.parametrize('dec', [-40., 34., 80.])
+def test_uvw_numpy(dec):
+    t0 = time.Time.now().mjd
+    meta = rfpipe.metadata.mock_metadata(t0, t0+60/(24*3600), 27, 4, 32*4, 4,
+                                         1e6, datasource='sim', antconfig='A')
+    meta['radec'] = (np.radians(123.), np.radians(dec))
+    st = rfpipe.state.State(inmeta=meta, inprefs={'dmarr': [0],
+                                                  'uvwbackend': 'numpy'})
+
+    datetime = rfpipe.util.qa.time(rfpipe.util.qa.quantity(t0, 'd'),
+                                   form='ymd', prec=8)[0]
+    uvw = np.array(rfpipe.util.calc_uvw(datetime, st.metadata.radec,
+                                        st.metadata.antpos,
+                                        st.metadata.telescope))
+    uvwnp = np.array(rfpipe.util.calc_uvw_numpy(t0, st.metadata.radec,
+                                                st.metadata.xyz))
+    assert np.abs(uvw - uvwnp).max() < 1e-4*np.linalg.norm(uvw, axis=0).max()
+
+    u, v, w = rfpipe.util.get_uvw_segment(st, 0)
+    assert u.shape == (st.nbl, len(st.freq))
+    assert st.npixx_full > 0
@@ -0,0 +1,91 @@
+from __future__ import print_function, division, absolute_import, unicode_literals
+from builtins import bytes, dict, object, range, map, input, str
+from future.utils import itervalues, viewitems, iteritems, listvalues, listitems
+from io import open
+
+import rfpipe, rfpipe.planner
+import pytest
+from astropy import time
+
+
+@pytest.fixture(scope="module")
+def mockstate():
+    t0 = time.Time.now().mjd
+    meta = rfpipe.metadata.mock_metadata(t0, t0+1/(24*3600), 20, 4, 32*4, 2,
+                                         5e3, datasource='sim', antconfig='D')
+    return rfpipe.state.State(inmeta=meta, inprefs={'dmarr': [0, 100],
+                                                    'dtarr': [1],
+                                                    'npix_max': 128,
+                                                    'fftmode': 'fftw'})
+
+
+def test_plan(mockstate):
+    segmenttimes, nworkers, summary = rfpipe.planner.plan_segments(mockstate)
+    assert nworkers == 1
+    assert len(summary) == len(segmenttimes)
+    assert (summary['peak'] > 0).all()
+
+    # tighter limit shortens segments, then drops workers
+    limit = summary['peak'].max()/2
+    segmenttimes2, nworkers2, summary2 = rfpipe.planner.plan_segments(mockstate, nworkers=2, memory_limit=limit)
+    assert len(segmenttimes2) > len(segmenttimes)
+    assert nworkers2*summary2['peak'].max() <= limit
+
+    with pytest.raises(ValueError):
+        rfpipe.planner.plan_segments(mockstate, memory_limit=1e-9)
+
+
+def test_memoryplan(mockstate):
+    segmenttimes, nworkers, summary = rfpipe.planner.plan_segments(mockstate)
+    limit = summary['peak'].max()
+    segmenttimes, nworkers, summary = rfpipe.planner.plan_segments(mockstate, nworkers=2, memory_limit=limit)
+    st = rfpipe.state.State(inmeta=mockstate.metadata,
+                            inprefs=dict(mockstate.prefs.ordered,
+                                         memoryplan=2, memory_limit=limit))
+    assert (st.segmenttimes == segmenttimes).all()
+    assert st.nworkers == nworkers == 2
+
+
+def test_memoryplan_scan(mockstate, monkeypatch):
+    import rfpipe.pipeline
+    from concurrent import futures
+
+    segmenttimes, nworkers, summary = rfpipe.planner.plan_segments(mockstate)
+    st = rfpipe.state.State(inmeta=mockstate.metadata,
+                            inprefs=dict(mockstate.prefs.ordered, memoryplan=2,
+                                         memory_limit=summary['peak'].max()))
+    assert st.nsegment > 1 and st.nworkers == 2
+
+    # segments go to st.nworkers workers with state rebuilt from snapshot
+    pools = []
+
+    class Executor(futures.ThreadPoolExecutor):
+        def __init__(self, max_workers, mp_context=None):
+            pools.append(max_workers)
+            super(Executor, self).__init__(max_workers=max_workers)
+
+    searched = []
+
+    def pipeline_seg(st1, segment, **kwargs):
+        assert st1 is not st and st1.dmarr == st.dmarr
+        searched.append(segment)
+        return rfpipe.candidates.CandCollection(prefs=st1.prefs,
+                                                metadata=st1.metadata)
+
+    monkeypatch.setattr(futures, 'ProcessPoolExecutor', Executor)
+    monkeypatch.setattr(rfpipe.pipeline, 'pipeline_seg', pipeline_seg)
+    rfpipe.pipeline.pipeline_scan(st)
+    assert pools == [2]
+    assert sorted(searched) == list(range(st.nsegment))
+
+
+def test_measure_model(mockstate):
+    model = rfpipe.planner.measure_model(mockstate)
+    assert [stage for stage, units in model] == [stage for stage, units in rfpipe.planner.memorymodel['fftw']]
+
+    readints = mockstate.readints
+    measured = dict(rfpipe.planner.stage_memory(mockstate, readints, model=model))
+    declared = dict(rfpipe.planner.stage_memory(mockstate, readints))
+    # declared model should be within factor of few of measured
+    for stage in measured:
+        assert declared[stage]/4 < measured[stage] < 4*declared[stage]
@@ -3,7 +3,7 @@ from builtins import bytes, dict, object, range, map, input, str
 from future.utils import itervalues, viewitems, iteritems, listvalues, listitems
 from io import open
 
-import rfpipe
+import rfpipe, rfpipe.candidates
 import pytest
 import os.path
 import os
@@ -54,3 +54,58 @@ def test_state():
     st = rfpipe.state.State(inmeta=inmeta, preffile=preffile,
                             inprefs={'chans': list(range(10))})
     assert st.chans == list(range(10))
+
+
+def test_namecache():
+    prefs = rfpipe.preferences.Preferences()
+    name = prefs.name
+    assert prefs.name is name
+    contentid = prefs.contentid
+
+    prefs.gainfile = 'test.GN'
+    assert prefs.name == name
+    assert prefs.contentid != contentid
+
+    prefs.flaglist = []
+    assert prefs.name != name
+    assert prefs.name == rfpipe.preferences.Preferences(gainfile='test.GN', flaglist=[]).name
+
+
+def test_oldpickle():
+    import pickle
+
+    # older pickles lack newer attributes
+    prefs = rfpipe.preferences.Preferences()
+    del prefs.__dict__['uvwbackend']
+    prefs = pickle.loads(pickle.dumps(prefs))
+    assert 'uvwbackend' not in prefs.ordered
+    assert '_nchange' not in prefs.ordered
+    assert prefs.name != rfpipe.preferences.Preferences().name
+
+
+def test_namecache_sum(monkeypatch):
+    import hashlib
+    import numpy as np
+
+    inmeta = rfpipe.metadata.mock_metadata(0, 1, 27, 16, 32, 4, 1e6)
+    st = rfpipe.state.State(inmeta=inmeta, showsummary=False)
+    ccs = [rfpipe.candidates.CandCollection(prefs=st.prefs,
+                                            metadata=st.metadata,
+                                            snapshot=st.snapshot())
+           for i in range(10)]
+
+    calls = []
+
+    class counter(object):
+        @staticmethod
+        def md5(data):
+            calls.append(data)
+            return hashlib.md5(data)
+
+        sha1 = staticmethod(hashlib.sha1)
+
+    st.prefs.fileroot = st.prefs.fileroot  # invalidates cache
+    monkeypatch.setattr(rfpipe.preferences, 'hashlib', counter)
+    cc = sum(ccs)
+    assert len(calls) == 1
+    assert cc.prefs.name == st.prefs.name
@@ -39,6 +39,10 @@ def test_cal_and_uncal(mockstate):
     datauncal = rfpipe.calibration.apply_telcal(mockstate, datacal, sign=-1)
     assert np.allclose(datauncal, data)
 
+    datacal2 = data.copy()
+    rfpipe.calibration.apply_telcal(mockstate, datacal2, sign=1, inplace=True)
+    assert np.allclose(datacal2, datacal)
+
 
 def test_simulated_source(mockstate):
     segment = 0
@@ -69,3 +73,20 @@ def test_simulated_source_zeroshift(mockstate):
                                   mockstate.uvres, mockstate.fftmode,
                                   1, integrations=0)
     assert im[0].max()/im[0].std() > 10
+
+
+def test_onlineflags(mockstate):
+    sdm = rfpipe.util.getsdm(mockstate.metadata.filename,
+                             bdfdir=mockstate.metadata.bdfdir)
+    scan = sdm.scan(mockstate.metadata.scan)
+
+    times = np.array(mockstate.segmenttimes)
+    mjds = np.linspace(times.min(), times.max(), 20)
+    flags = rfpipe.flagging.query_onlineflagtable(mockstate.onlineflagtable,
+                                                  mjds)
+    assert (flags == scan.flags(mjds)).all()
+
+    for segment in range(mockstate.nsegment):
+        t0, t1 = mockstate.segmenttimes[segment]
+        flags = rfpipe.flagging.getonlineflags(mockstate, segment)
+        assert (flags == scan.flags([t0, t1]).all(axis=0)).all()
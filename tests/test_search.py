@@ -7,6 +7,7 @@ import rfpipe
 import pytest
 from astropy import time
 import numpy as np
+import numba
 
 
 @pytest.fixture(scope="module")
@@ -129,3 +130,38 @@ def test_dmresample_singlemulti2(st, data):
 
     assert np.allclose(data1, data2)
     assert np.allclose(data3, data2)
+
+
+@pytest.mark.parametrize('mode', ['mean', 'median', 'sigmaclip'])
+def test_meantsub_singlemulti(data, mode):
+    data0 = data.copy()
+    data0[:, 0, 5] = 0j  # flagged channel
+    data0[2:4, 1] = 0j  # flagged ints
+
+    data1 = rfpipe.util.meantsub(data0.copy(), parallel=False, mode=mode)
+    data2 = rfpipe.util.meantsub(data0.copy(), parallel=True, mode=mode)
+    nthread0 = numba.get_num_threads()
+    data3 = rfpipe.util.meantsub(data0.copy(), parallel=True, mode=mode,
+                                 nthread=1)
+
+    assert np.allclose(data1, data2)
+    assert np.allclose(data1, data3)
+    assert numba.get_num_threads() == nthread0
+    assert (data1[data0 == 0j] == 0j).all()
+    if mode == 'mean':
+        mean = np.ma.masked_equal(data0, 0j).mean(axis=0).filled(0j)
+        assert np.allclose(data1, np.where(data0 != 0j, data0 - mean, 0j),
+                           atol=1e-5)
+
+
+def test_meantsub_outlier(data):
+    data0 = data.copy()
+    data0[len(data0)//2] += 100.  # bright broadband transient
+
+    bias = {}
+    for mode in ['mean', 'median', 'sigmaclip']:
+        datas = rfpipe.util.meantsub(data0.copy(), mode=mode)
+        bias[mode] = np.abs(np.delete(datas, len(data0)//2, axis=0).mean())
+
+    assert bias['median'] < bias['mean']
+    assert bias['sigmaclip'] < bias['mean']
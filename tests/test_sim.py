@@ -4,9 +4,12 @@ from future.utils import itervalues, viewitems, iteritems, listvalues, listitems
 from io import open
 
 import rfpipe, rfpipe.candidates
+import os.path
+import glob
 import pytest
 from astropy import time
 from numpy import degrees, nan
+import numpy as np
 
 tparams = [(0, 0, 0, 5e-3, 0.3, 0.0001, 0.0),]
 # simulate no flag, transient/no flag, transient/flag
@@ -55,6 +58,21 @@ def test_noise(mockstate, mockdata):
         assert len(noises)
 
 
+def test_flags(mockstate, mockdata):
+    flags = list(rfpipe.candidates.iter_flags(mockstate.flagfile))
+    assert [segment for segment, summary in flags] == [0]
+    assert flags[0][1]['mode'][0] == 'initial'
+
+    # segments are appended to one file per scan
+    data, summary = rfpipe.flagging.flag_data(mockstate, mockdata.copy(),
+                                              returnsummary=True)
+    rfpipe.source.save_flags(mockstate, 1, summary)
+    flags = list(rfpipe.candidates.iter_flags(mockstate.flagfile))
+    assert [segment for segment, summary in flags] == [0, 1]
+    assert (flags[1][1]['nflagged'] == summary['nflagged']).all()
+    assert not glob.glob(os.path.splitext(mockstate.flagfile)[0] + '_seg*')
+
+
 def test_pipelinescan(mockstate):
     cc = rfpipe.pipeline.pipeline_scan(mockstate)
     if mockstate.prefs.simulated_transient is not None:
@@ -89,3 +107,203 @@ def test_phasecenter_detection():
     cc = rfpipe.pipeline.pipeline_scan(st)
     assert all(cc.array['l1'] == 0.)
     assert all(cc.array['m1'] == 0.)
+
+
+def test_add_transients():
+    t0 = time.Time.now().mjd
+    meta = rfpipe.metadata.mock_metadata(t0, t0+0.1/(24*3600), 20, 4, 32*4, 2,
+                                         5e3, scan=1, datasource='sim',
+                                         antconfig='D')
+    st = rfpipe.state.State(inmeta=meta, inprefs={'dmarr': [0, 100]})
+    uvw = rfpipe.util.get_uvw_segment(st, 0)
+    gain = (np.random.normal(size=st.datashape[1:]) +
+            1j*np.random.normal(size=st.datashape[1:])).astype('complex64')
+    transients = [(2.3, 0, 5e-3, 0.3, 0.001, 0., 0.),
+                  (5.5, 100, 9e-3, 0.2, 0., -0.002, 0.1),
+                  (5.5, 0, 5e-3, 0.2, 0., 0., 0.),
+                  (st.readints+1, 0, 5e-3, 0.2, 0., 0., 0.)]  # skipped
+
+    data = np.zeros(st.datashape, dtype='complex64')
+    assert rfpipe.util.add_transients(st, data, transients, uvw, gain=gain) == 3
+
+    # dense model per transient
+    dataref = np.zeros(st.datashape, dtype='complex64')
+    for (i0, dm, dt, amp, l, m, ampslope) in transients[:3]:
+        model = np.require(np.broadcast_to(rfpipe.util.make_transient_data(st, amp, i0, dm, dt, ampslope=ampslope)
+                                           .transpose()[:, None, :, None],
+                                           st.datashape), requirements='W')
+        model *= gain
+        rfpipe.util.phase_shift(model, uvw, -l, -m)
+        dataref += model
+
+    assert np.allclose(data, dataref, atol=1e-5)
+
+
+def test_mock_map():
+    t0 = time.Time.now().mjd
+    meta = rfpipe.metadata.mock_metadata(t0, t0+0.1/(24*3600), 10, 4, 32*4, 2,
+                                         5e3, datasource='sim')
+    # dt in seconds. second mock is resampled by 2 at an odd integration
+    mocks = [(0, 10, 1., 5e-3, 1., 0., 0.), (0, 11, 2., 10e-3, 1., 0., 0.)]
+    st = rfpipe.state.State(inmeta=meta, inprefs={'dmarr': [0, 1, 2],
+                                                  'dtarr': [1, 2],
+                                                  'simulated_transient': mocks})
+    fields = [str(ff) for ff in ['segment', 'integration', 'dmind', 'dtind',
+                                 'beamnum', 'snr1', 'cluster']]
+    array = np.zeros(3, dtype=list(zip(fields, ['<i4']*5 + ['<f4', '<i4'])))
+    # unresampled mock has same loc as before. resampled mock is at
+    # integration 11//2 and dtind 1, not at the old (0, 11, 2, 0, 0).
+    array[0] = (0, 10, 1, 0, 0, 10., 0)
+    array[1] = (0, 5, 2, 1, 0, 10., 1)
+    array[2] = (0, 11, 2, 0, 0, 10., 2)
+    cc = rfpipe.candidates.CandCollection(array=array, prefs=st.prefs,
+                                          metadata=st.metadata)
+    map_mocks, mock_labels = cc.mock_map
+    assert mock_labels == [0, 1]
+    assert map_mocks[mocks[0]] == [[0, 10, 1, 0, 0]]
+    assert map_mocks[mocks[1]] == [[0, 5, 2, 1, 0]]
+
+
+@pytest.mark.parametrize('nworkers', [1, 2])
+def test_campaign(tmpdir, nworkers):
+    t0 = time.Time.now().mjd
+    meta = rfpipe.metadata.mock_metadata(t0, t0+0.1/(24*3600), 20, 4, 32*4, 2,
+                                         5e3, scan=1, datasource='sim',
+                                         antconfig='D')
+    inprefs = {'dmarr': [0], 'dtarr': [1], 'timesub': None, 'fftmode': 'fftw',
+               'searchtype': 'image', 'sigma_image1': 10, 'flaglist': [],
+               'uvres': 60, 'npix_max': 128, 'maxdm': 0}
+    campaignfile = str(tmpdir.join('campaign.npz'))
+    summary = rfpipe.pipeline.pipeline_campaign({'inmeta': meta,
+                                                 'inprefs': inprefs},
+                                                [0], [0], [50.], nrep=2,
+                                                nworkers=nworkers,
+                                                campaignfile=campaignfile)
+    assert len(summary) == 1
+    assert summary['ntrial'][0] == 2
+    assert summary['fraction'][0] == 1.
+    assert summary['t_search'][0] > 0
+
+    saved = np.load(campaignfile)
+    assert (saved['summary'] == summary).all()
+    assert len(saved['trials']) == 2
+
+    with pytest.raises(ValueError):
+        rfpipe.pipeline.pipeline_campaign({'inmeta': meta,
+                                           'inprefs': dict(inprefs, dtarr=[1, 2, 4])},
+                                          [0], [2], [50.])
+
+
+def test_simulate_segment():
+    t0 = time.Time.now().mjd
+    meta = rfpipe.metadata.mock_metadata(t0, t0+0.1/(24*3600), 10, 4, 32*4, 2,
+                                         5e3, datasource='sim')
+    st1 = rfpipe.state.State(inmeta=meta, inprefs={'nthread': 1})
+    st4 = rfpipe.state.State(inmeta=meta, inprefs={'nthread': 4})
+    data1 = rfpipe.source.simulate_segment(st1, seed=1)
+    assert data1.shape == st1.datashape_orig
+    assert data1.dtype == np.complex64
+    assert (data1 == rfpipe.source.simulate_segment(st4, seed=1)).all()
+    assert np.isclose(data1.real.std(), 1., atol=0.01)
+    assert np.isclose(data1.imag.std(), 1., atol=0.01)
+
+    st = rfpipe.state.State(inmeta=meta,
+                            inprefs={'simulated_rfi': (4, 2, 10.),
+                                     'simulated_gain': True})
+    data = rfpipe.source.simulate_segment(st, seed=1)
+    assert data.shape == st.datashape_orig
+    assert np.abs(data).mean() > np.abs(data1).mean()
+
+
+def test_simulate_segment_oldnumpy(monkeypatch):
+    t0 = time.Time.now().mjd
+    meta = rfpipe.metadata.mock_metadata(t0, t0+0.1/(24*3600), 10, 4, 32*4, 2,
+                                         5e3, datasource='sim')
+    st1 = rfpipe.state.State(inmeta=meta, inprefs={'nthread': 1})
+    st4 = rfpipe.state.State(inmeta=meta,
+                             inprefs={'nthread': 4,
+                                      'simulated_rfi': (4, 2, 10.),
+                                      'simulated_gain': True})
+
+    # numpy<1.17 has neither SeedSequence nor default_rng
+    monkeypatch.delattr(np.random, 'SeedSequence')
+    monkeypatch.delattr(np.random, 'default_rng')
+    data1 = rfpipe.source.simulate_segment(st1, seed=1)
+    assert data1.shape == st1.datashape_orig
+    assert data1.dtype == np.complex64
+    assert np.isclose(data1.real.std(), 1., atol=0.01)
+    st1.prefs.nthread = 4
+    assert (data1 == rfpipe.source.simulate_segment(st1, seed=1)).all()
+    data4 = rfpipe.source.simulate_segment(st4, seed=1)
+    assert (data4 == rfpipe.source.simulate_segment(st4, seed=1)).all()
+
+
+def test_replay(monkeypatch):
+    from rfpipe import replay
+    import time as pytime
+
+    t0 = time.Time.now().mjd
+    meta = rfpipe.metadata.mock_metadata(t0, t0+0.4/(24*3600), 10, 4, 32*4, 2,
+                                         5e3, datasource='replay')
+    st = rfpipe.state.State(inmeta=meta, inprefs={'dmarr': [0]})
+    t0, t1 = 24*3600*(st.segmenttimes[0] - st.metadata.starttime_mjd)
+
+    # replay starts with first read
+    tstart = pytime.time()
+    data = rfpipe.source.read_segment(st, 0)
+    assert pytime.time() - tstart >= t1 - t0
+    assert data.shape == st.datashape_orig
+    assert data.all()
+
+    # open reader halfway through window, so first ints are dropped
+    replay.start(st, pytime.time() - (t0 + t1)/2)
+    with replay.Reader(st, 0) as reader:
+        data = reader.readwindow()
+    assert not data[0].any()
+    assert data[-1].all()
+    assert 0 < reader.ndropped < st.readints
+
+    # data is made before reader opens, so thread only paces integrations
+    calls = []
+    simulate_segment = rfpipe.source.simulate_segment
+
+    def simulate(*args, **kwargs):
+        calls.append(pytime.time())
+        return simulate_segment(*args, **kwargs)
+
+    monkeypatch.setattr(rfpipe.source, 'simulate_segment', simulate)
+    replay.start(st)
+    reader = replay.Reader(st, 0)
+    with reader:
+        data = reader.readwindow()
+    assert len(calls) == 1 and calls[0] < reader.topen
+
+
+@pytest.mark.parametrize('timesub', [None, 'median'])
+def test_warmup(timesub):
+    import numba
+
+    if numba.config.DISABLE_JIT:
+        assert not len(rfpipe.pipeline.pipeline_warmup({'timesub': timesub}))
+        pytest.skip("numba jit disabled")
+
+    summary = rfpipe.pipeline.pipeline_warmup({'timesub': timesub})
+    assert len(summary)
+    assert (summary['nsig'] > 0).all()
+    if timesub == 'median':
+        assert '_meantsub_jit' in summary['kernel']
+
+    # nothing left to compile in this process
+    summary = rfpipe.pipeline.pipeline_warmup({'timesub': timesub})
+    assert (summary['seconds'] == 0).all()
+
+
+def test_numba_kernels_oldnumba(monkeypatch):
+    import sys
+    from numba.core import registry
+
+    # older numba has registry in numba.targets
+    monkeypatch.setitem(sys.modules, 'numba.core.registry', None)
+    monkeypatch.setitem(sys.modules, 'numba.targets.registry', registry)
+    kernels = rfpipe.pipeline._numba_kernels()
+    assert '_slidemed_jit' in kernels
@@ -4,7 +4,7 @@ from future.utils import itervalues, viewitems, iteritems, listvalues, listitems
 from io import open
 
 import pytest
-import rfpipe
+import rfpipe, rfpipe.candidates
 from astropy import time
 
 
@@ -44,6 +44,191 @@ def test_clearcache(mockstate):
     assert (segmenttimes == mockstate.segmenttimes).all()
 
 
+def test_delaytable(mockstate):
+    import numpy as np
+
+    table = mockstate.delaytable
+    assert table.shape == (len(mockstate.dmarr), mockstate.nchan)
+    for dmind, dm in enumerate(mockstate.dmarr):
+        ref = [int(4.1488e-3*dm*(1./f**2 - 1./mockstate.freq.max()**2) /
+                   mockstate.inttime) for f in mockstate.freq]
+        assert (table[dmind] == ref).all()
+    assert mockstate.dmshifts == list(table.max(axis=1))
+
+    # old versions scale delays only when reproducing candidates
+    import rfpipe.reproduce
+    st = rfpipe.state.State(inmeta=mockstate.metadata,
+                            inprefs={'dmarr': [0, 200, 400]},
+                            showsummary=False)
+    table = st.delaytable
+    t_overlap = st.t_overlap
+    st.rtpipe_version = 1.54
+    st.clearcache()
+    assert st.dmscale == 4.2e-3
+    assert (st.delaytable == table).all()
+    assert st.t_overlap == t_overlap
+    for dmind, dm in enumerate(st.dmarr):
+        ref = [int(4.2e-3*dm*(1./f**2 - 1./st.freq.max()**2) /
+                   st.inttime) for f in st.freq]
+        assert (rfpipe.reproduce._dmdelay(st, dmind) == ref).all()
+    assert (rfpipe.reproduce._dmdelay(st, 2) > table[2]).any()
+    del st.rtpipe_version
+    assert (rfpipe.reproduce._dmdelay(st, 2) == table[2]).all()
+
+
+def test_lightweight(mockstate, monkeypatch):
+    # derived quantities are not computed until used
+    for name in ['calc_dmarr', 'calc_segment_times', 'calc_uvrange',
+                 'calc_delaytable']:
+        monkeypatch.setattr(rfpipe.util, name, None)
+    st = rfpipe.state.State(inmeta=mockstate.metadata,
+                            inprefs=mockstate.prefs.ordered,
+                            validate=False, showsummary=False)
+    assert not [key for key in ['_dmarr', '_segmenttimes', '_blarr',
+                                '_delaytable', '_npixx_full', '_memo']
+                if key in st.__dict__]
+    with pytest.raises(TypeError):
+        st.dmarr
+
+
+def test_memoized(mockstate):
+    chans = mockstate.chans
+    assert mockstate.chans == chans
+    assert mockstate.freq is mockstate.freq
+    assert not mockstate.freq.flags.writeable
+    assert sum([len(cc) for cc in mockstate.spw_chan_select]) == mockstate.nchan
+
+    # changing returned lists does not change cache
+    mockstate.chans.remove(chans[0])
+    mockstate.spw_chan_select[0].pop()
+    assert mockstate.chans == chans
+    assert sum([len(cc) for cc in mockstate.spw_chan_select]) == mockstate.nchan
+
+    # prefs change invalidates
+    mockstate.prefs.ignore_spwedge = 0
+    assert mockstate.nchan == mockstate.metadata.nchan_orig
+    assert len(mockstate.freq) == mockstate.nchan
+    assert mockstate.spw_chan_select[1] == list(range(32, 64))
+
+    # metadata change invalidates
+    nbl = mockstate.nbl
+    antids = mockstate.metadata.antids
+    mockstate.prefs.ignore_spwedge = 0.075
+    mockstate.metadata.antids = antids[:-1]
+    assert mockstate.nbl < nbl
+    assert mockstate.chans == chans
+
+    mockstate.metadata.antids = antids
+    mockstate.clearcache()
+    assert mockstate.nbl == nbl
+
+
+def test_snapshot(mockstate, monkeypatch):
+    import pickle
+    import numpy as np
+
+    snap = mockstate.snapshot()
+    with pytest.raises(AttributeError):
+        snap.dmarr = [0.]
+    assert not snap.segmenttimes.flags.writeable
+    assert snap.dtarr == tuple(mockstate.dtarr)
+    assert snap.uvres == mockstate.uvres
+
+    # one snapshot is shared until prefs change
+    assert mockstate.snapshot() is snap
+    st = rfpipe.state.State(inmeta=mockstate.metadata,
+                            inprefs=mockstate.prefs.ordered)
+    snap1 = st.snapshot()
+    st.prefs.sigma_image1 = 7.1
+    assert st.snapshot() is not snap1
+    assert snap1.prefs.sigma_image1 != 7.1
+
+    # rebuilt without recalculating dmarr or segmenttimes
+    snap = pickle.loads(pickle.dumps(snap))
+    monkeypatch.setattr(rfpipe.util, 'calc_dmarr', None)
+    monkeypatch.setattr(rfpipe.util, 'calc_segment_times', None)
+    monkeypatch.setattr(rfpipe.util, 'calc_uvrange', None)
+    st = rfpipe.state.State.from_snapshot(snap)
+    assert st.dmarr == mockstate.dmarr
+    assert (st.segmenttimes == mockstate.segmenttimes).all()
+    assert (st.blarr == mockstate.blarr).all()
+    assert (st.npixx, st.npixy) == (mockstate.npixx, mockstate.npixy)
+    assert st.uvres == mockstate.uvres
+    assert st.freq is snap.freq
+    assert st.chans == mockstate.chans
+
+    # snapshot does not share prefs/metadata with states
+    assert st.prefs is not snap.prefs and st.metadata is not snap.metadata
+    snap2 = st.snapshot()
+    st.prefs.maxdm = 1.
+    st.metadata.scan = 99
+    assert snap2.prefs.maxdm != 1. and snap2.metadata.scan != 99
+    assert snap.prefs.maxdm != 1.
+
+    # collection keeps only derived values and builds state from own prefs
+    cc = rfpipe.candidates.CandCollection(prefs=mockstate.prefs,
+                                          metadata=mockstate.metadata,
+                                          snapshot=mockstate.snapshot())
+    assert cc.snapshot.prefs is None and cc.snapshot.metadata is None
+    cc0 = rfpipe.candidates.CandCollection(prefs=mockstate.prefs,
+                                           metadata=mockstate.metadata)
+    assert (len(pickle.dumps(cc)) <=
+            len(pickle.dumps(cc0)) + len(pickle.dumps(cc.snapshot)))
+    assert (len(pickle.dumps(cc.snapshot)) <
+            len(pickle.dumps(mockstate.snapshot()))/2)
+    cc = pickle.loads(pickle.dumps(cc))
+    assert cc._state is None
+    assert cc.state.dmarr == mockstate.dmarr
+    assert cc.state.prefs is cc.prefs and cc.state.metadata is cc.metadata
+    cc.prefs.simulated_transient = 1
+    assert cc.state.prefs.simulated_transient == 1
+    with pytest.raises(ValueError):
+        rfpipe.state.State.from_snapshot(cc.snapshot)
+
+
+def calc_dmarr_ref(st):
+    """ Original loop over 0.05 grid steps """
+    import numpy as np
+
+    tsamp = st.inttime*1e6
+    k = 8.3
+    freq = st.freq.mean()
+    bw = 1e3*(st.freq.max() - st.freq.min())
+    ch = 1e-6*st.metadata.spw_chansize[0]
+    dt0 = lambda dm: np.sqrt(st.prefs.dm_pulsewidth**2 + tsamp**2 + ((k*dm*ch)/(freq**3))**2)
+    dt1 = lambda dm, ddm: np.sqrt(st.prefs.dm_pulsewidth**2 + tsamp**2 + ((k*dm*ch)/(freq**3))**2 + ((k*ddm*bw)/(freq**3.))**2)
+    loss = lambda dm, ddm: 1 - np.sqrt(dt0(dm)/dt1(dm, ddm))
+
+    dmgrid = np.arange(st.prefs.mindm, st.prefs.maxdm, 0.05)
+    dmgrid_final = [dmgrid[0]]
+    for i in range(len(dmgrid)):
+        ddm = (dmgrid[i] - dmgrid_final[-1])/2.
+        if loss(dmgrid[i], ddm) > st.prefs.dm_maxloss:
+            dmgrid_final.append(dmgrid[i])
+    if st.prefs.maxdm not in dmgrid_final:
+        dmgrid_final.append(st.prefs.maxdm)
+    return dmgrid_final
+
+
+@pytest.mark.parametrize('maxdm', [100, 3000])
+def test_dmarr(maxdm):
+    t0 = time.Time.now().mjd
+    meta = rfpipe.metadata.mock_metadata(t0, t0+0.3/(24*3600), 27, 4, 32*4, 4,
+                                         5e3, datasource='sim')
+    st = rfpipe.state.State(inmeta=meta, inprefs={'maxdm': maxdm},
+                            validate=False, showsummary=False)
+
+    assert st.dmarr == calc_dmarr_ref(st)
+    assert rfpipe.util.calc_dmarr(st) == st.dmarr
+    assert rfpipe.util.calc_dmarr(st) is not rfpipe.util.calc_dmarr(st)
+
+    # cache keeps only recent grids
+    for mindm in range(rfpipe.util._dmarrcachesize + 2):
+        st.prefs.mindm = mindm
+        rfpipe.util.calc_dmarr(st)
+    assert len(rfpipe.util._dmarrcache) == rfpipe.util._dmarrcachesize
+
+
 def test_lowmem():
     t0 = time.Time.now().mjd
     meta = rfpipe.metadata.mock_metadata(t0, t0+0.3/(24*3600), 27, 4, 32*4, 4,